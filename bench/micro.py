@@ -0,0 +1,318 @@
+#! /usr/bin/env python3
+"""
+Micro-benchmarks of the hot paths, at several input sizes.
+
+Each benchmark is timed with timeit (best of --repeat runs) for every
+size, and the results are written as a JSON baseline together with the
+scaling exponent of each benchmark (the slope of log(time) over log(n):
+about 1 for linear work, 2 for quadratic). Comparing against an earlier
+baseline flags benchmarks that got slower or scale worse.
+
+    python bench/micro.py --save baseline.json
+    python bench/micro.py --compare baseline.json
+    python bench/micro.py rarest_piece next_request --sizes 10000,100000
+"""
+import argparse
+import hashlib
+import json
+import math
+import os
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import timeit
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC)
+
+from bencoding import Decoder, Encoder
+from bitset import BitSet
+from client import PeerStream
+from MessageType import Bitfield
+from Piecetracker import Piece, Piecetracker, REQUEST_SIZE
+from storage import Storage
+from torrent import Torrent
+
+# input sizes (number of pieces, or messages for the codec benchmarks)
+SIZES = (10000, 30000, 100000)
+# peers connected to the piece tracker in the picker benchmarks
+PEERS = 200
+# a benchmark is reported as a regression when it got this much slower
+THRESHOLD = 1.25
+
+BENCHMARKS = {}
+
+
+def benchmark(function):
+    """
+    Registers a benchmark. It is called with the input size and returns
+    (the function to time, the number of calls to time it for) and,
+    for a function changing what it works on, a third item: a function
+    putting that back in its initial state before every timing run
+    """
+    BENCHMARKS[function.__name__] = function
+    return function
+
+
+def _metainfo(pieces: int, files: int = None) -> dict:
+    files = files or max(1, pieces // 10)
+    return {b'announce': b'http://127.0.0.1:1/announce', b'info': {
+        b'name': b'bench', b'piece length': 2**18,
+        b'pieces': os.urandom(20 * pieces),
+        b'files': [{b'length': 2**18 * pieces // files, b'path': [b'dir', b'file%d' % i]}
+                   for i in range(files)],
+    }}
+
+
+_workdir = tempfile.mkdtemp(prefix='bt-micro-')
+# piece trackers and storages, closed once all the benchmarks ran
+_opened = []
+
+
+def _piecetracker(pieces: int, peers: int = PEERS) -> Piecetracker:
+    """
+    A piece tracker for a single-file torrent of `pieces` pieces with
+    `peers` peers, each having a random 7/8 of the pieces
+    """
+    path = os.path.join(_workdir, 'bench-%d.torrent' % pieces)
+    with open(path, 'wb') as f:
+        Encoder({b'announce': b'http://127.0.0.1:1/announce', b'info': {
+            b'name': b'bench.bin', b'piece length': 2**15, b'length': 2**15 * pieces,
+            b'pieces': os.urandom(20 * pieces)}}).write(f)
+    pieceTracker = Piecetracker(Torrent(path), output_dir=os.path.join(_workdir, 'out'), hash_workers=1)
+    rng = random.Random(pieces)
+    for peer in range(peers):
+        bits = rng.getrandbits(pieces) | rng.getrandbits(pieces) | rng.getrandbits(pieces)
+        bitfield = BitSet(pieces)
+        bitfield._bytes[:] = bits.to_bytes(len(bitfield._bytes), 'big')
+        bitfield._clear_padding()
+        pieceTracker.add_peer(peer, bitfield)
+    _opened.append(pieceTracker)
+    return pieceTracker
+
+
+def _picker_reset(pieceTracker: Piecetracker):
+    """
+    A function restoring the picker state `pieceTracker` has now: the
+    pieces started by the timed calls go back to missing, so every
+    timing run (and every size) picks from the same state
+    """
+    missing = set(pieceTracker.missing_pieces)
+    rarity = {count: set(bucket) for count, bucket in pieceTracker.rarity.items()}
+    rarity_peak = dict(pieceTracker.rarity_peak)
+    rarest = pieceTracker.rarest
+    interesting = dict(pieceTracker.interesting)
+    ongoing = dict(pieceTracker.ongoing_pieces)
+
+    def reset():
+        pieceTracker.missing_pieces = set(missing)
+        pieceTracker.rarity = {count: set(bucket) for count, bucket in rarity.items()}
+        pieceTracker.rarity_peak = dict(rarity_peak)
+        pieceTracker.rarest = rarest
+        pieceTracker.interesting = dict(interesting)
+        pieceTracker.ongoing_pieces = dict(ongoing)
+    return reset
+
+
+@benchmark
+def bencode_decode(n):
+    data = Encoder(_metainfo(n)).encode()
+    return (lambda: Decoder(data).decode()), 1
+
+
+@benchmark
+def bencode_encode(n):
+    metainfo = _metainfo(n)
+    return (lambda: Encoder(metainfo).encode()), 1
+
+
+@benchmark
+def peerstream_framing(n):
+    # n messages, a Piece per 8 Haves, read in 256 KiB chunks
+    block = os.urandom(REQUEST_SIZE)
+    messages = []
+    for i in range(n):
+        if i % 9 == 0:
+            messages.append(struct.pack('>IBII', 9 + len(block), 7, i, 0) + block)
+        else:
+            messages.append(struct.pack('>IBI', 5, 4, i))
+    data = b''.join(messages)
+    chunks = [data[offset:offset + 2**18] for offset in range(0, len(data), 2**18)]
+
+    def frame():
+        stream = PeerStream(None)
+        for chunk in chunks:
+            stream._feed(chunk)
+            stream.messages.clear()
+    return frame, 1
+
+
+@benchmark
+def bitfield_decode(n):
+    message = bytes([5]) + os.urandom(math.ceil(n / 8))
+    return (lambda: Bitfield.decode(message)), 100
+
+
+@benchmark
+def rarest_piece(n):
+    pieceTracker = _piecetracker(n)
+    rng = random.Random(1)
+    peers = [rng.randrange(PEERS) for _ in range(100)]
+
+    def pick():
+        for peer in peers:
+            pieceTracker._get_rarest_piece(peer)
+    return pick, 1, _picker_reset(pieceTracker)
+
+
+@benchmark
+def next_request(n):
+    pieceTracker = _piecetracker(n)
+    rng = random.Random(2)
+    peers = [rng.randrange(PEERS) for _ in range(1000)]
+
+    def request():
+        blocks = [(peer, pieceTracker.next_request(peer)) for peer in peers]
+        for peer, block in blocks:
+            pieceTracker.release_block(block.piece, block.offset, peer)
+    # released blocks are missing again, but their pieces stay ongoing
+    return request, 1, _picker_reset(pieceTracker)
+
+
+@benchmark
+def piece_assembly(n):
+    # n blocks spread over 1 MiB pieces
+    blocks = os.urandom(REQUEST_SIZE)
+    per_piece = 2**20 // REQUEST_SIZE
+    pieces = max(1, n // per_piece)
+
+    def assemble():
+        for index in range(pieces):
+            status = memoryview(bytearray(per_piece))
+            piece = Piece(index, 2**20, b'', status)
+            for number in range(per_piece):
+                piece.block_received(number * REQUEST_SIZE, blocks)
+            hashlib.sha1(piece.data).digest()
+            piece.release()
+    return assemble, 1
+
+
+@benchmark
+def storage_write(n):
+    # n 16 KiB blocks worth of 256 KiB pieces written to a multi-file torrent
+    pieces = max(1, n * REQUEST_SIZE // 2**18)
+    files = 8
+    path = os.path.join(_workdir, 'write-%d.torrent' % n)
+    with open(path, 'wb') as f:
+        Encoder({b'announce': b'http://127.0.0.1:1/announce', b'info': {
+            b'name': b'w', b'piece length': 2**18, b'pieces': os.urandom(20 * pieces),
+            b'files': [{b'length': 2**18 * pieces // files + (i == 0) * (2**18 * pieces % files),
+                        b'path': [b'w%d' % i]} for i in range(files)]}}).write(f)
+    storage = Storage(Torrent(path), os.path.join(_workdir, 'write-%d' % n))
+    _opened.append(storage)
+    data = memoryview(os.urandom(2**18))
+
+    def write():
+        for index in range(pieces):
+            storage.write(index, 0, [data])
+    return write, 1
+
+
+def run(names, sizes, repeat: int) -> dict:
+    results = {}
+    for name in names:
+        timings = {}
+        for n in sizes:
+            setup = BENCHMARKS[name](n)
+            function, number = setup[:2]
+            reset = setup[2] if len(setup) > 2 else None
+            timer = timeit.Timer(function)
+            runs = []
+            for _ in range(repeat):
+                if reset:
+                    reset()
+                runs.append(timer.timeit(number))
+            best = min(runs) / number
+            timings[str(n)] = best
+            print('{:<20} n={:<8} {:>12.6f} s'.format(name, n, best))
+        results[name] = {'timings': timings, 'scaling': _scaling(timings)}
+    return results
+
+
+def _scaling(timings: dict) -> float:
+    """
+    Least squares slope of log(time) over log(n)
+    """
+    points = [(math.log(int(n)), math.log(max(t, 1e-9))) for n, t in timings.items()]
+    if len(points) < 2:
+        return None
+    mean_x = sum(x for x, _ in points) / len(points)
+    mean_y = sum(y for _, y in points) / len(points)
+    var = sum((x - mean_x) ** 2 for x, _ in points)
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / var
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """
+    The regressions of `results` against `baseline`
+    """
+    problems = []
+    for name, result in results.items():
+        old = baseline.get(name)
+        if not old:
+            continue
+        for n, best in result['timings'].items():
+            before = old['timings'].get(n)
+            if before and best > before * threshold:
+                problems.append('{} n={}: {:.6f}s -> {:.6f}s ({:.2f}x)'.format(
+                    name, n, before, best, best / before))
+        if result['scaling'] is not None and old.get('scaling') is not None and \
+           result['scaling'] > old['scaling'] + 0.3:
+            problems.append('{}: scaling exponent {:.2f} -> {:.2f}'.format(
+                name, old['scaling'], result['scaling']))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description='micro-benchmarks of the codec and picker hot paths')
+    parser.add_argument('benchmarks', nargs='*', help='benchmarks to run (default: all of them)')
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)),
+                        help='comma separated input sizes (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5, help='timing runs per size (default: %(default)s)')
+    parser.add_argument('--save', help='write the results as a JSON baseline to this file')
+    parser.add_argument('--compare', help='compare against this JSON baseline, exit 1 on regressions')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='slowdown counted as a regression (default: %(default)s)')
+    args = parser.parse_args()
+
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        parser.error('unknown benchmark(s): {}'.format(', '.join(unknown)))
+    sizes = [int(size) for size in args.sizes.split(',')]
+
+    try:
+        results = run(args.benchmarks or list(BENCHMARKS), sizes, args.repeat)
+    finally:
+        for opened in _opened:
+            opened.close()
+        shutil.rmtree(_workdir, ignore_errors=True)
+    for name, result in results.items():
+        if result['scaling'] is not None:
+            print('{:<20} scaling exponent {:.2f}'.format(name, result['scaling']))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            problems = compare(results, json.load(f), args.threshold)
+        for problem in problems:
+            print('REGRESSION ' + problem)
+        if problems:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,387 @@
+#! /usr/bin/env python3
+"""
+Local swarm simulator and end-to-end throughput benchmark.
+
+Every scenario generates a synthetic torrent, starts fake seeders on
+localhost speaking the peer wire protocol (with configurable latency,
+bandwidth, choking and corruption) and runs the real download path of
+src/main against them. The download runs in a process of its own, so the
+reported CPU time and peak RSS are the client's alone.
+
+    python bench/swarm.py                      # every scenario
+    python bench/swarm.py single-256k lossy   # some of them
+    python bench/swarm.py --scale 4 --json results.json
+"""
+import argparse
+import asyncio
+import hashlib
+import importlib.machinery
+import importlib.util
+import json
+import math
+import multiprocessing
+import os
+import random
+import resource
+import struct
+import sys
+import tempfile
+import time
+from collections import deque, namedtuple
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC)
+
+from bencoding import Encoder
+from ratelimit import RateLimiter
+
+# a benchmark setup: `files` are the file sizes in MiB (one file makes a
+# single-file torrent), latency is in seconds, bandwidth in bytes per second
+# per seeder (0 for unlimited), choke_rate is the chance a seeder chokes us
+# for a while every second and corrupt_rate the chance a block is garbled
+Scenario = namedtuple('Scenario', ['name', 'files', 'piece_length', 'seeders', 'latency',
+                                   'bandwidth', 'choke_rate', 'corrupt_rate',
+                                   'pipeline_depth', 'adaptive'])
+
+SCENARIOS = [
+    Scenario('single-256k', [64], 2**18, 4, 0.0, 0, 0.0, 0.0, 5, False),
+    Scenario('single-16k', [16], 2**14, 4, 0.0, 0, 0.0, 0.0, 5, False),
+    Scenario('multi-1m', [8, 0.001, 24, 15.5, 16], 2**20, 4, 0.0, 0, 0.0, 0.0, 5, False),
+    Scenario('latency', [32], 2**18, 4, 0.05, 0, 0.0, 0.0, 5, False),
+    Scenario('latency-adaptive', [32], 2**18, 4, 0.05, 0, 0.0, 0.0, 5, True),
+    Scenario('slow-tail', [32], 2**18, 4, 0.01, 4 * 2**20, 0.0, 0.0, 5, False),
+    Scenario('lossy', [32], 2**18, 4, 0.01, 0, 0.2, 0.001, 5, False),
+]
+
+# seconds a choking seeder keeps us choked
+CHOKE_TIME = 1.0
+
+
+def make_payload(scenario: Scenario, scale: float, seed: int) -> bytes:
+    size = sum(int(mib * scale * 2**20) or 1 for mib in scenario.files)
+    return random.Random(seed).randbytes(size)
+
+
+def make_torrent(path: str, scenario: Scenario, payload: bytes, scale: float) -> None:
+    """
+    Writes the .torrent of `payload`, cut into the scenario's files
+    """
+    piece_length = scenario.piece_length
+    pieces = b''.join(hashlib.sha1(payload[offset:offset + piece_length]).digest()
+                      for offset in range(0, len(payload), piece_length))
+    info = {b'name': scenario.name.encode(), b'piece length': piece_length, b'pieces': pieces}
+    if len(scenario.files) == 1:
+        info[b'length'] = len(payload)
+    else:
+        info[b'files'] = [{b'length': int(mib * scale * 2**20) or 1, b'path': [b'file%d' % i]}
+                          for i, mib in enumerate(scenario.files)]
+    with open(path, 'wb') as f:
+        Encoder({b'announce': b'http://127.0.0.1:1/announce', b'info': info}).write(f)
+
+
+class FakeSeeder:
+    """
+    A seeder serving `payload` to whoever connects. Requests are answered
+    in order after `latency` seconds, paced to `bandwidth`. Every second the
+    seeder chokes the peer for CHOKE_TIME with probability `choke_rate`
+    (dropping its queued requests, as the protocol says), and every block
+    is garbled with probability `corrupt_rate`.
+    """
+    def __init__(self, payload: bytes, piece_length: int, info_hash: bytes, latency: float = 0.0,
+                 bandwidth: int = 0, choke_rate: float = 0.0, corrupt_rate: float = 0.0,
+                 seed: int = 0):
+        self.payload = payload
+        self.piece_length = piece_length
+        self.info_hash = info_hash
+        self.latency = latency
+        # a small burst so the bandwidth holds from the first block on
+        self.limiter = RateLimiter(bandwidth, burst=2**16)
+        self.choke_rate = choke_rate
+        self.corrupt_rate = corrupt_rate
+        self.random = random.Random(seed)
+        self.peer_id = b'-FS0001-' + b'%012d' % seed
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0):
+        self.server = await asyncio.start_server(self._serve, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    def close(self):
+        self.server.close()
+
+    async def _serve(self, reader, writer):
+        try:
+            handshake = await reader.readexactly(68)
+            if handshake[28:48] != self.info_hash:
+                return
+            writer.write(struct.pack('>B19s8x20s20s', 19, b'BitTorrent protocol',
+                                     self.info_hash, self.peer_id))
+            num_pieces = math.ceil(len(self.payload) / self.piece_length)
+            bitfield = bytearray(b'\xff' * math.ceil(num_pieces / 8))
+            if num_pieces % 8:
+                bitfield[-1] = (0xff << (8 - num_pieces % 8)) & 0xff
+            writer.write(struct.pack('>IB', 1 + len(bitfield), 5) + bitfield)
+
+            session = _Session(self, writer)
+            tasks = [asyncio.ensure_future(session.respond()),
+                     asyncio.ensure_future(session.choker())]
+            try:
+                while True:
+                    length = struct.unpack('>I', await reader.readexactly(4))[0]
+                    if length:
+                        session.handle(await reader.readexactly(length))
+            finally:
+                for task in tasks:
+                    task.cancel()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+class _Session:
+    """
+    The seeder's side of one connection
+    """
+    def __init__(self, seeder: FakeSeeder, writer):
+        self.seeder = seeder
+        self.writer = writer
+        self.choked = True
+        # (due time, index, begin, length) of the requests to answer
+        self.queue = deque()
+        self.wakeup = asyncio.Event()
+
+    def handle(self, message: bytes):
+        message_id = message[0]
+        if message_id == 2 and self.choked:  # interested
+            self._set_choked(False)
+        elif message_id == 6 and not self.choked:  # request
+            index, begin, length = struct.unpack_from('>III', message, 1)
+            self.queue.append((time.monotonic() + self.seeder.latency, index, begin, length))
+            self.wakeup.set()
+        elif message_id == 8:  # cancel
+            request = struct.unpack_from('>III', message, 1)
+            self.queue = deque(item for item in self.queue if item[1:] != request)
+
+    def _set_choked(self, choked: bool):
+        self.choked = choked
+        if choked:
+            self.queue.clear()
+        self.writer.write(struct.pack('>IB', 1, 0 if choked else 1))
+
+    async def choker(self):
+        if not self.seeder.choke_rate:
+            return
+        while True:
+            await asyncio.sleep(1)
+            if not self.choked and self.seeder.random.random() < self.seeder.choke_rate:
+                self._set_choked(True)
+                await asyncio.sleep(CHOKE_TIME)
+                self._set_choked(False)
+
+    async def respond(self):
+        seeder = self.seeder
+        while True:
+            if not self.queue:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            due, index, begin, length = self.queue.popleft()
+            delay = due - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            start = index * seeder.piece_length + begin
+            block = seeder.payload[start:start + length]
+            if seeder.corrupt_rate and seeder.random.random() < seeder.corrupt_rate:
+                block = bytes(len(block))
+            await seeder.limiter.consume(len(block))
+            if self.choked:
+                continue
+            self.writer.write(struct.pack('>IBII', 9 + len(block), 7, index, begin))
+            self.writer.write(block)
+            await self.writer.drain()
+
+
+class LocalTracker:
+    """
+    Stands in for the trackers: hands the seeders' addresses over once
+    """
+    def __init__(self, peers):
+        self.peers = peers
+        self.peer_id = '-BT0001-' + ''.join(random.choice('0123456789') for _ in range(12))
+
+    async def run(self, pieceTracker, on_peers):
+        on_peers(self.peers)
+        await asyncio.Event().wait()
+
+    async def stop(self, pieceTracker):
+        pass
+
+    def close(self):
+        pass
+
+
+def _run_seeders(scenario: Scenario, scale: float, seed: int, info_hash: bytes, conn):
+    """
+    Child process running the scenario's seeders, their ports are sent
+    back over `conn` and they run until something is received on it
+    """
+    payload = make_payload(scenario, scale, seed)
+
+    async def serve():
+        seeders = [FakeSeeder(payload, scenario.piece_length, info_hash, scenario.latency,
+                              scenario.bandwidth, scenario.choke_rate, scenario.corrupt_rate,
+                              seed=seed + i)
+                   for i in range(scenario.seeders)]
+        conn.send([await seeder.start() for seeder in seeders])
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, conn.recv)
+        for seeder in seeders:
+            seeder.close()
+
+    asyncio.run(serve())
+
+
+def _run_download(scenario: Scenario, torrent_path: str, output_dir: str, ports, conn):
+    """
+    Child process downloading the torrent through main.download, reports
+    its measurements over `conn`
+    """
+    import log
+    from Piecetracker import Piecetracker
+    from torrent import Torrent
+    loader = importlib.machinery.SourceFileLoader('bittorrent_main', os.path.join(SRC, 'main'))
+    spec = importlib.util.spec_from_loader('bittorrent_main', loader)
+    main = importlib.util.module_from_spec(spec)
+    loader.exec_module(main)
+
+    listener = log.setup('WARNING')
+    wall = time.monotonic()
+    cpu = time.process_time()
+    torrent = Torrent(torrent_path)
+    pieceTracker = Piecetracker(torrent, output_dir=output_dir)
+    tracker = LocalTracker([('127.0.0.1', port) for port in ports])
+    first_piece = []
+    last_piece = []
+
+    async def download():
+        async def watch_pieces():
+            while not pieceTracker.have_count:
+                await asyncio.sleep(0.005)
+            first_piece.append(time.monotonic() - wall)
+            # the download is done here, shutting down the sessions and
+            # announcing to the tracker afterwards is not part of it
+            await pieceTracker.completed.wait()
+            last_piece.append(time.monotonic() - wall)
+        watcher = asyncio.ensure_future(watch_pieces())
+        await main.download(torrent, tracker, pieceTracker, scenario.pipeline_depth,
+                            scenario.adaptive, port=0)
+        watcher.cancel()
+
+    asyncio.run(download())
+    # an interrupted download counts until it stopped
+    last_piece = last_piece[0] if last_piece else time.monotonic() - wall
+    pieceTracker.close()
+    listener.stop()
+    conn.send({
+        'size': torrent.total_size,
+        'pieces': len(torrent.pieces),
+        'time_to_first_piece': first_piece[0] if first_piece else None,
+        'time_to_last_piece': last_piece,
+        'throughput_mb_s': torrent.total_size / 2**20 / last_piece,
+        'cpu_seconds': time.process_time() - cpu,
+        'peak_rss_mb': _peak_rss_mb(),
+        'hash_failures': pieceTracker.metrics.hash_failures,
+    })
+
+
+def _peak_rss_mb() -> float:
+    """
+    Peak resident set size of this process. ru_maxrss survives exec on
+    Linux, so it would report the parent's peak if that was higher; the
+    VmHWM of /proc starts over with the new program.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # kilobytes on Linux, bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 2**20 if sys.platform == 'darwin' else maxrss / 1024
+
+
+def run_scenario(scenario: Scenario, scale: float = 1.0, seed: int = 1) -> dict:
+    """
+    Runs one scenario end to end and returns its measurements
+    """
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory(prefix='bt-bench-') as directory:
+        payload = make_payload(scenario, scale, seed)
+        torrent_path = os.path.join(directory, scenario.name + '.torrent')
+        make_torrent(torrent_path, scenario, payload, scale)
+        del payload
+        from torrent import Torrent
+        info_hash = Torrent(torrent_path).info_hash
+
+        seeders_conn, child_conn = context.Pipe()
+        seeders = context.Process(target=_run_seeders,
+                                  args=(scenario, scale, seed, info_hash, child_conn))
+        seeders.start()
+        try:
+            ports = seeders_conn.recv()
+            result_conn, child_conn = context.Pipe()
+            client = context.Process(target=_run_download,
+                                     args=(scenario, torrent_path, os.path.join(directory, 'out'),
+                                           ports, child_conn))
+            client.start()
+            client.join()
+            if client.exitcode != 0:
+                raise RuntimeError('download of {} failed'.format(scenario.name))
+            result = result_conn.recv()
+        finally:
+            seeders_conn.send('stop')
+            seeders.join()
+    result['scenario'] = scenario.name
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='end to end download benchmark against local fake seeders')
+    parser.add_argument('scenarios', nargs='*', help='scenarios to run (default: all of them)')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiply the scenario sizes by this (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per scenario (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the payload and the seeders')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--list', action='store_true', help='list the scenarios and exit')
+    args = parser.parse_args()
+
+    scenarios = {scenario.name: scenario for scenario in SCENARIOS}
+    if args.list:
+        for scenario in SCENARIOS:
+            print(scenario)
+        return
+    unknown = [name for name in args.scenarios if name not in scenarios]
+    if unknown:
+        parser.error('unknown scenario(s): {}'.format(', '.join(unknown)))
+
+    results = []
+    print('{:<18} {:>8} {:>9} {:>9} {:>9} {:>8} {:>8}'.format(
+        'scenario', 'MiB', 'MB/s', 'last (s)', 'cpu (s)', 'rss (MB)', 'hashfail'))
+    for name in args.scenarios or list(scenarios):
+        for _ in range(args.repeat):
+            result = run_scenario(scenarios[name], args.scale, args.seed)
+            results.append(result)
+            print('{:<18} {:>8.1f} {:>9.1f} {:>9.2f} {:>9.2f} {:>8.1f} {:>8}'.format(
+                name, result['size'] / 2**20, result['throughput_mb_s'],
+                result['time_to_last_piece'], result['cpu_seconds'],
+                result['peak_rss_mb'], result['hash_failures']))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,7 @@
 import struct
 
+from bitset import BitSet
+
 REQUEST_SIZE = 2**14
 
 # diffrent message ID
@@ -19,6 +21,9 @@ class Unchoke:
     Message format: <len=0001><id=1>
     Peer is allowed to request for pieces
     """
+    def encode(self) -> bytes:
+        return struct.pack('>Ib', 1, UNCHOKE)
+
     def __str__(self):
         return 'Unchoke'
 
@@ -27,6 +32,9 @@ class Choke:
     Message format: <len=0001><id=0>
     Peer can't request for pieces
     """
+    def encode(self) -> bytes:
+        return struct.pack('>Ib', 1, CHOKE)
+
     def __str__(self):
         return 'Choke'
 
@@ -45,6 +53,9 @@ class NotInterested:
     """
     Message format: <len=0001><id=3>
     """
+    def encode(self) -> bytes:
+        return struct.pack('>Ib', 1, NOTINTERESTED)
+
     def __str__(self):
         return 'NotInterested'
 
@@ -61,9 +72,8 @@ class Bitfield:
     what pieces the peer have, and what they don't
     """
     def __init__(self, data):
-        temp = ''.join(format(byte, '08b') for byte in data) 
-        #turning out string into a byte array
-        self.bitfield = bytearray(temp, 'utf-8')
+        # one bit per piece, as sent on the wire
+        self.bitfield = BitSet.from_bytes(data)
 
     @classmethod
     def decode(cls, data: bytes) -> bytes:
@@ -115,9 +125,8 @@ class Request:
         """
         Args: data (bytes): raw bytes of incoming request msg
         """
-        parts = struct.unpack('>bIII', data)
-        print('decoding request: index: {}, begin: {}, length: {}'.format(part[1], part[2], part[3]))
-        return cls(parts[1], parts[2], parts[3])
+        parts = struct.unpack_from('>III', data, 1)
+        return cls(parts[0], parts[1], parts[2])
 
     def __str__(self) -> str:
         return 'Request'
@@ -136,20 +145,45 @@ class Have:
         data format: <id><payload>
         since length is already consumed by client.py
         """
-        index = struct.unpack('>I', data[1:])[0]
+        index = struct.unpack_from('>I', data, 1)[0]
         return cls(index)
 
-    def encode(self, piece):
+    def encode(self):
         return struct.pack('>IbI',
             5,  # Message length
             HAVE,
-            piece.index)
+            self.index)
 
     def __str__(self):
         return 'Have'
 
 
 class Cancel:
+    """
+    Message format: <len=0013><id=8><index><begin><length>
+    Withdraws a previous Request
+    """
+    def __init__(self, index: int, begin: int, length: int = REQUEST_SIZE) -> None:
+        self.index = index
+        self.begin = begin
+        self.length = length
+
+    @classmethod
+    def decode(cls, data: bytes):
+        """
+        Args: data (bytes): raw bytes of incoming cancel msg
+        """
+        parts = struct.unpack_from('>III', data, 1)
+        return cls(parts[0], parts[1], parts[2])
+
+    def encode(self) -> bytes:
+        return struct.pack('>IbIII',
+            13,
+            CANCEL,
+            self.index,
+            self.begin,
+            self.length)
+
     def __str__(self):
         return 'Cancel'
 
@@ -166,25 +200,26 @@ class Piece:
         self.block = block
 
 
-    def encode(data):
+    def encode(self):
         message_length = 9 + len(self.block)
-        return struct.pack('>IbII' + str(len(self.block)) + 's',
+        # the block may be a memoryview, which struct's 's' format won't take
+        return struct.pack('>IbII',
                             message_length,
                             PIECE,
                             self.index,
-                            self.begin,
-                            data)
+                            self.begin) + self.block
 
     @classmethod
-    def decode(cls, data: bytes):
+    def decode(cls, data: memoryview):
         # The Piece message length without the block data is 9
 
         """
         data format: <message_id><piece_index><begin_index><piece_data>
+        When given a memoryview the block is a view into the same buffer,
+        the block data is not copied.
         """
 
-        piece_index = struct.unpack('>I', data[1:5])[0]
-        begin_index = struct.unpack('>I', data[5:9])[0]
+        piece_index, begin_index = struct.unpack_from('>II', data, 1)
         piece_data = data[9:]
 
         return cls(piece_index, begin_index, piece_data)
@@ -1,4 +1,5 @@
 import asyncio
+import logging
 import struct
 import random
 import string
@@ -9,10 +10,16 @@ import time
 from hashlib import sha1
 from typing import List
 from torrent import Torrent 
-from collections import namedtuple, defaultdict
-from concurrent.futures import CancelledError
+from storage import Storage
+from bitset import BitSet
+from bencoding import Decoder, Encoder
+from metrics import Metrics
+from collections import namedtuple, deque
+from concurrent.futures import CancelledError, ThreadPoolExecutor
 from MessageType import Unchoke, Choke, Interested, NotInterested, Have, Bitfield, KeepAlive, Cancel, Piece, Request
 REQUEST_SIZE = 2**14 # 16384
+
+logger = logging.getLogger(__name__)
 """
 Diffulty coming up with a algorithm to request what piece --> what to request first
 """
@@ -22,64 +29,113 @@ class Block:
     """
     The block is a partial piece, this is what is requested and transferred
     between peers.
+    Blocks are only created when they are handed out for requesting, their
+    status lives in the Piecetracker's block_status array.
     """
     Missing = 0
     Pending = 1
     Retrieved = 2
 
+    __slots__ = ('piece', 'offset', 'length')
+
     def __init__(self, piece: int, offset: int, length: int):
         self.piece = piece
         self.offset = offset
         self.length = length
-        self.status = Block.Missing
-        self.data = None
 
 
 class Piece:
-    def __init__(self, index: int, blocks: [], hash_value):
+    """
+    A piece being downloaded. `status` is the slice of the Piecetracker's
+    block_status array covering this piece's blocks.
+    """
+    def __init__(self, index: int, length: int, hash_value, status):
         self.index = index
-        self.blocks = blocks
+        self.length = length
         self.hash = hash_value
+        self.status = status
+        self.num_blocks = len(status)
+        # block numbers (within the piece) still to be requested
+        self.missing = deque(i for i in range(self.num_blocks) if status[i] == Block.Missing)
+        self.received = sum(1 for i in range(self.num_blocks) if status[i] == Block.Retrieved)
+        # the piece data, blocks are copied in at their offset as they arrive
+        self.buffer = None
 
     def reset(self):
         """
         Reset all blocks to Missing regardless of current state.
         """
-        for block in self.blocks:
-            block.status = Block.Missing
+        for i in range(self.num_blocks):
+            self.status[i] = Block.Missing
+        self.missing = deque(range(self.num_blocks))
+        self.received = 0
+
+    def _block_length(self, number: int) -> int:
+        """
+        Length of block `number`, the last block of the last piece may be shorter
+        """
+        if number == self.num_blocks - 1:
+            return self.length - number * REQUEST_SIZE
+        return REQUEST_SIZE
+
+    def _block_number(self, offset: int) -> int:
+        """
+        The number of the block starting at `offset`, or None when no block starts there
+        """
+        number = offset // REQUEST_SIZE
+        if offset % REQUEST_SIZE == 0 and number < self.num_blocks:
+            return number
+        return None
 
     def next_request(self) -> Block:
         """
         Get the next Block to be requested
         """
-        missing = [b for b in self.blocks if b.status is Block.Missing]
-        if missing:
-            missing[0].status = Block.Pending
-            return missing[0]
+        if self.missing:
+            number = self.missing.popleft()
+            self.status[number] = Block.Pending
+            return Block(self.index, number * REQUEST_SIZE, self._block_length(number))
         return None
 
+    def block_released(self, offset: int) -> bool:
+        """
+        Put a requested block back to Missing, the request won't be answered
+        :return: True if the block was pending
+        """
+        number = self._block_number(offset)
+        if number is not None and self.status[number] == Block.Pending:
+            self.status[number] = Block.Missing
+            self.missing.appendleft(number)
+            return True
+        return False
+
     def block_received(self, offset: int, data: bytes):
         """
         Update block information that the given block is now received
         :param offset: The block offset (within the piece)
         :param data: The block data
         """
-        matches = [b for b in self.blocks if b.offset == offset]
-        block = matches[0] if matches else None
-        if block:
-            block.status = Block.Retrieved
-            block.data = data
-        else:
-            print('Trying to complete a non-existing block {offset}'
-                            .format(offset=offset))
+        number = self._block_number(offset)
+        if number is None or len(data) != self._block_length(number):
+            logger.warning('Trying to complete a non-existing block %d of piece %d',
+                           offset, self.index)
+        elif self.status[number] != Block.Retrieved:
+            # duplicates of a block we already have are dropped
+            if self.status[number] == Block.Missing:
+                self.missing.remove(number)
+            self.status[number] = Block.Retrieved
+            self.received += 1
+            if self.buffer is None:
+                self.buffer = bytearray(self.length)
+            # the only copy the block data goes through on its way to disk
+            self.buffer[offset:offset + len(data)] = data
 
     def is_complete(self) -> bool:
         """
         Checks if all blocks for this piece is retrieved (regardless of SHA1)
         :return: True or False
         """
-        blocks = [b for b in self.blocks if b.status is not Block.Retrieved]
-        return len(blocks) is 0
+        return self.received == self.num_blocks
 
     def is_hash_matching(self):
         """
@@ -87,22 +143,30 @@ class Piece:
         from the torrent meta-info.
         :return: True or False
         """
-        piece_hash = sha1(self.data).digest()
+        piece_hash = sha1(self.buffer).digest()
         return self.hash == piece_hash
 
     @property
     def data(self):
         """
-        Return the data for this piece (by concatenating all blocks in order)
+        Return the data for this piece, the blocks are already in order in
+        the piece buffer
         NOTE: This method does not control that all blocks are valid or even
         existing!
         """
-        retrieved = sorted(self.blocks, key=lambda b: b.offset)
-        blocks_data = [b.data for b in retrieved]
-        return b''.join(blocks_data)
+        return memoryview(self.buffer)
+
+    def release(self):
+        """
+        Drop the piece buffer once the piece is on disk
+        """
+        self.buffer = None
 
-# The type used for keeping track of pending request that can be re-issued
-PendingRequest = namedtuple('PendingRequest', ['block', 'added'])
+# The type used for keeping track of pending request that can be re-issued,
+# `peers` are the ids of the peers the block was requested from
+PendingRequest = namedtuple('PendingRequest', ['block', 'slot', 'peers'])
+# width in seconds of a slot of the pending request timer wheel
+TIMER_RESOLUTION = 1
 File = namedtuple('File', ['file_length', 'file_pieces', 'pieces_written', 'blocks_written', 'current_idx'])
 
 class Piecetracker:
@@ -110,117 +174,320 @@ class Piecetracker:
     The PieceManager is responsible for keeping track of all available
     pieces for the connected peers and what pieces we need to request next
     """
-    def __init__(self, torrent: Torrent) -> None:
+    def __init__(self, torrent: Torrent, output_dir: str = 'result', hash_workers: int = None,
+                 metrics: Metrics = None) -> None:
         self.torrent = torrent
+        # throughput / latency metrics of the download, shared with the clients
+        self.metrics = metrics or Metrics()
         self.peers = {}
-        self.pending_blocks = []
-        self.missing_pieces = []
-        self.ongoing_pieces = []
-        self.have_pieces = [] # array of pieces
-        self.max_pending_time = 300 * 1000  # 5 minutes
-
-        #create an array for all of our missin gpieces
-        self.missing_pieces = self.fetch_pieces()
-
-        # create an array that have all of our pieces in the torrent
-        self.pieces_list = self.fetch_pieces()
-        self.total_pieces = len(torrent.pieces)
-
-        # an array that holds our file information for writing purposes
-        self.file_info = {}
-        self.file_info = self.populate_file_info()
-
-        # to keep track of what file we are currently on
-        self.curr_file_idx = 0
-
-        # array that keeps track of all pieces when finished
-        self.result = []
-    
-        self.fd = []
-        for dest in self.torrent.files:
-            if type(dest.name) is list:
-                tmp = "result/" + (dest.name[0].decode("utf-8"))
-            elif type(dest.name) is bytes:
-                tmp = "result/" + (dest.name[0]).decode("utf-8") 
-            else:
-                tmp = "result/" + (dest.name)
-            curr = os.open(tmp, os.O_RDWR | os.O_CREAT)
-            self.fd.append(curr)
+        # (piece index, block offset) -> PendingRequest of the blocks requested
+        self.pending_blocks = {}
+        # timer wheel slot -> keys of the pending requests expiring in it
+        self.pending_timers = {}
+        # the first timer wheel slot that has not been expired yet
+        self.timer_slot = int(time.monotonic() // TIMER_RESOLUTION)
+        # pending requests that expired and wait for a peer to re-request them
+        self.expired_blocks = {}
+        # piece index -> piece of the pieces being downloaded, Piece objects
+        # only exist for these
+        self.ongoing_pieces = {}
+        self.max_pending_time = 300  # 5 minutes
+
+        self.piece_hashes = torrent.pieces
+        self.total_pieces = len(self.piece_hashes)
+        self.piece_length = torrent.piece_length
+        self.total_size = torrent.total_size
+
+        # the status (Block.Missing/Pending/Retrieved) of every block of the
+        # torrent, one byte each, indexed by piece * blocks_per_piece + block
+        self.blocks_per_piece = math.ceil(self.piece_length / REQUEST_SIZE)
+        self.block_status = bytearray(self.total_pieces * self.blocks_per_piece)
+        self._block_status = memoryview(self.block_status)
+
+        #create a set of the indices of all of our missing pieces
+        self.missing_pieces = set(range(self.total_pieces))
+
+        # the pieces we have verified and written to disk
+        self.have = BitSet(self.total_pieces)
+        self.have_count = 0
+
+        # counters reported to the tracker, in bytes
+        self.downloaded = 0
+        self.uploaded = 0
+
+        # availability index for rarest-first:
+        # availability[i] is the number of connected peers having piece i and
+        # rarity[k] is the set of missing pieces that exactly k peers have.
+        # Empty buckets are deleted and buckets that shrank a lot are rebuilt,
+        # a set keeps its table size when emptied and walking it stays slow
+        self.availability = [0] * self.total_pieces
+        self.rarity = {0: set(self.missing_pieces)} if self.total_pieces else {}
+        # count -> largest size of rarity[count] since it was (re)built
+        self.rarity_peak = {0: self.total_pieces}
+        # lower bound of the smallest non-zero count having a bucket
+        self.rarest = 1
+        # peer_id -> number of missing pieces the peer has
+        self.interesting = {}
+
+        # maps pieces onto the output file(s), pieces are written to disk
+        # through it as soon as they are verified
+        self.storage = Storage(torrent, output_dir)
+        # fast-resume state: what we have and the files it was saved for
+        self.resume_file = os.path.join(output_dir, '.{}.resume'.format(torrent.info_hash.hex()))
+
+        # pieces are hashed and written off the event loop, on this pool
+        self.hash_pool = ThreadPoolExecutor(max_workers=hash_workers or os.cpu_count())
+        # piece index -> future of the pieces being verified
+        self.verifying = {}
+        # set once every piece is verified and on disk
+        self.completed = asyncio.Event()
+
+        # peer_id -> Client of the peers we are connected to
+        self.connections = {}
         
-    def fetch_pieces(self) -> List[Piece]:
-        """
-        return the list of missing pieces. And for each piece, construct its blocks.
-        """
-        torrent = self.torrent
-        pieces = []
-        total_pieces = len(torrent.pieces)
-        blocks_per_piece = math.ceil(torrent.piece_length / REQUEST_SIZE)
-        for i, hash_value in enumerate(torrent.pieces):
-            # Number of blocks for each piece is calculated as
-            # CEIL(piece length / request size)
-            # Note: final piece could have fewer blocks as well as 
-            # the final block might be smaller than the rest.
-            if i < (total_pieces - 1): # if not last piece
-                blocks = [Block(i, offset * REQUEST_SIZE, REQUEST_SIZE)
-                            for offset in range(blocks_per_piece)]
-            else:
-                # account for (likely) smaller size of last piece
-                last_piece_len = torrent.total_size % torrent.piece_length
-                num_blocks = math.ceil(last_piece_len / REQUEST_SIZE)
-                
-                blocks = [Block(i, offset * REQUEST_SIZE, REQUEST_SIZE)
-                            for offset in range(num_blocks)]
-
-                if last_piece_len % REQUEST_SIZE > 0:
-                    # account for (likely) smaller size of last block
-                    last_block = blocks[-1]
-                    last_block.length = last_piece_len % REQUEST_SIZE
-                    blocks[-1] = last_block
-
-            # construct Piece and add to list of missing pieces
-            pieces.append(Piece(i, blocks, hash_value))
-        return pieces
+    def _piece_size(self, index: int) -> int:
+        """
+        Length of piece `index`, the last piece is (likely) shorter
+        """
+        if index == self.total_pieces - 1:
+            return self.total_size - index * self.piece_length
+        return self.piece_length
+
+    def _new_piece(self, index: int) -> Piece:
+        """
+        Construct the Piece for index, its block states are a view into the
+        block_status array.
+        """
+        length = self._piece_size(index)
+        first = index * self.blocks_per_piece
+        num_blocks = math.ceil(length / REQUEST_SIZE)
+        return Piece(index, length, self.piece_hashes[index],
+                     self._block_status[first:first + num_blocks])
 
     # generate a bitfield message to indiciate what we have and what we don't
-    def return_bitfield(self):
-        data = ''
-        for piece in self.torrent.pieces:
-            if piece in self.have_pieces:
-                data += '1'
-            else:
-                data += '0'
-        return int(data, 2)
-        
-    
+    def return_bitfield(self) -> bytes:
+        return self.have.to_bytes()
 
     def close(self):
         """
-        Close open output file
+        Save the fast-resume state and close open output file
+        """
+        self.hash_pool.shutdown()
+        self.save_resume()
+        self.storage.close()
+
+    async def resume(self) -> int:
+        """
+        Picks up the pieces an earlier run left in the output files. When the
+        fast-resume state still matches the files (same sizes and modification
+        times) its have-bitfield is trusted, otherwise every piece the files
+        hold data for is hashed, in parallel on the hash pool.
+        Returns:
+            int: number of pieces we already have
+        """
+        have = self._load_resume()
+        if have is not None:
+            indices = list(have.indices())
+        else:
+            candidates = [index for index in range(self.total_pieces)
+                          if self.storage.on_disk(index)]
+            loop = asyncio.get_event_loop()
+            results = await asyncio.gather(*[
+                loop.run_in_executor(self.hash_pool, self._check_piece, index)
+                for index in candidates])
+            indices = [index for index, ok in zip(candidates, results) if ok]
+
+        for index in indices:
+            self._mark_have(index)
+        if self.complete:
+            self.completed.set()
+        return len(indices)
+
+    def _check_piece(self, index: int) -> bool:
+        """
+        Runs on the hash pool: whether piece `index` on disk matches its hash
+        """
+        data = self.storage.read(index, 0, self._piece_size(index))
+        return len(data) == self._piece_size(index) and \
+            sha1(data).digest() == self.piece_hashes[index]
+
+    def _mark_have(self, index: int):
+        """
+        Piece `index` is already verified on disk, take it off the missing
+        pieces
+        """
+        if self.have[index]:
+            return
+        self._leave_missing(index)
+        first = index * self.blocks_per_piece
+        num_blocks = math.ceil(self._piece_size(index) / REQUEST_SIZE)
+        self.block_status[first:first + num_blocks] = bytes([Block.Retrieved]) * num_blocks
+        self.have[index] = True
+        self.have_count += 1
+
+    def _load_resume(self):
+        """
+        The have-bitfield of the fast-resume state, None if there is no state
+        or the files changed since it was saved
+        """
+        try:
+            with open(self.resume_file, 'rb') as f:
+                state = Decoder(f.read()).decode()
+        except (OSError, EOFError, RuntimeError):
+            return None
+        if type(state) is not dict or state.get(b'info_hash') != self.torrent.info_hash or \
+           state.get(b'files') != self.storage.file_stats():
+            return None
+        return BitSet.from_bytes(state[b'have'], self.total_pieces)
+
+    def save_resume(self):
+        """
+        Write the fast-resume state next to the output files. It is replaced
+        atomically so a crash never leaves a half written state behind.
         """
-        if self.fd:
-            os.close(self.fd)
+        state = {
+            b'info_hash': self.torrent.info_hash,
+            b'have': self.have.to_bytes(),
+            b'files': self.storage.file_stats(),
+        }
+        tmp = self.resume_file + '.tmp'
+        with open(tmp, 'wb') as f:
+            Encoder(state).write(f)
+        os.replace(tmp, self.resume_file)
 
     @property
     def complete(self) -> bool:
         """
         return true if all pieces have been downloaded, false otherwise
         """
-        return len(self.have_pieces) == self.total_pieces
+        return self.have_count == self.total_pieces
 
 
+    @property
+    def left(self) -> int:
+        """
+        number of bytes we still have to download
+        """
+        have = self.have_count * self.piece_length
+        if self.have_count and self.have[self.total_pieces - 1]:
+            # the last piece is (likely) shorter
+            have -= self.piece_length - self._piece_size(self.total_pieces - 1)
+        return self.total_size - have
+
     def add_peer(self, peer_id, bitfield):
         """
-        Adds a peer and its bitfield to dict of peers.
+        Adds a peer and its bitfield (a BitSet) to dict of peers.
         """   
+        if (len(bitfield) + 7) // 8 != (self.total_pieces + 7) // 8:
+            # BEP 3: a bitfield of the wrong length drops the connection
+            raise ConnectionError('bitfield of {} bytes for {} pieces'.format(
+                (len(bitfield) + 7) // 8, self.total_pieces))
+        if peer_id in self.peers:
+            # a second bitfield replaces the first one
+            self.remove_peer(peer_id)
+        # drop the spare bits padding out the last byte
+        bitfield.truncate(self.total_pieces)
         self.peers[peer_id] = bitfield
+        self.interesting[peer_id] = 0
+        for index in bitfield.indices():
+            self._change_availability(index, 1)
+            if index in self.missing_pieces:
+                self.interesting[peer_id] += 1
 
     def update_peer(self, peer_id, i: int):
         """
         Updates bitfield of a peer for have messages
         """
-        if peer_id in self.peers:
-            if self.peers[peer_id][i] == 0:
-                self.peers[peer_id][i] = 1 # set bit to indicate peer has piece i
+        if i >= self.total_pieces:
+            return
+        if peer_id not in self.peers:
+            # peers having no pieces yet may skip the bitfield message
+            self.peers[peer_id] = BitSet(self.total_pieces)
+            self.interesting[peer_id] = 0
+        if not self._has_piece(peer_id, i):
+            self.peers[peer_id][i] = True # set bit to indicate peer has piece i
+            self._change_availability(i, 1)
+            if i in self.missing_pieces:
+                self.interesting[peer_id] += 1
+
+    def add_connection(self, client):
+        """
+        Registers a connected client so it can be told about new work
+        """
+        self.connections[client.remote_id] = client
+
+    def remove_connection(self, client):
+        if self.connections.get(client.remote_id) is client:
+            del self.connections[client.remote_id]
+
+    def _wake_peers(self):
+        """
+        Blocks became requestable again, let every connected peer retry
+        """
+        for client in self.connections.values():
+            client.wakeup()
+
+    def remove_peer(self, peer_id):
+        """
+        Forgets a disconnected peer and the pieces it made available
+        """
+        bitfield = self.peers.pop(peer_id, None)
+        self.interesting.pop(peer_id, None)
+        if bitfield is not None:
+            for index in bitfield.indices():
+                self._change_availability(index, -1)
+
+    def _has_piece(self, peer_id, index) -> bool:
+        """
+        Whether the given peer announced having piece `index`
+        """
+        bitfield = self.peers[peer_id]
+        return index < len(bitfield) and bitfield[index]
+
+    def _change_availability(self, index, delta):
+        """
+        Updates how many peers have piece `index` and, while the piece is still
+        missing, moves it to the rarity bucket for its new count
+        """
+        count = self.availability[index]
+        self.availability[index] = count + delta
+        if index in self.missing_pieces:
+            self._bucket_discard(count, index)
+            self._bucket_add(count + delta, index)
+
+    def _bucket_add(self, count, index):
+        bucket = self.rarity.get(count)
+        if bucket is None:
+            bucket = self.rarity[count] = set()
+            self.rarity_peak[count] = 0
+            if 0 < count < self.rarest:
+                self.rarest = count
+        bucket.add(index)
+        if len(bucket) > self.rarity_peak[count]:
+            self.rarity_peak[count] = len(bucket)
+
+    def _bucket_discard(self, count, index):
+        bucket = self.rarity[count]
+        bucket.discard(index)
+        if not bucket:
+            del self.rarity[count]
+            del self.rarity_peak[count]
+        elif len(bucket) * 4 < self.rarity_peak[count]:
+            # copying is paid for by the discards that shrank the bucket
+            self.rarity[count] = set(bucket)
+            self.rarity_peak[count] = len(bucket)
+
+    def _leave_missing(self, index):
+        """
+        Piece `index` is no longer missing (it is being downloaded or we have
+        it), take it out of the rarity index
+        """
+        self._bucket_discard(self.availability[index], index)
+        self.missing_pieces.discard(index)
+        if self.availability[index]:
+            for peer_id in self.peers:
+                if self._has_piece(peer_id, index):
+                    self.interesting[peer_id] -= 1
 
     def next_request(self, peer_id) -> Block:
         """
@@ -234,73 +501,208 @@ class Piecetracker:
             block = self._next_ongoing(peer_id)
             if not block:
                 tmp = self._get_rarest_piece(peer_id)
-                if tmp is None:
-                    return None
-                else:
+                if tmp is not None:
                     block = tmp.next_request()
                 #block = self._get_rarest_piece(peer_id).next_request()
+        if block:
+            self._add_pending(block, peer_id)
+        elif self._in_endgame():
+            block = self._endgame_request(peer_id)
         return block
 
+    def _in_endgame(self) -> bool:
+        """
+        Endgame starts once every block we still need has been requested
+        """
+        return not self.missing_pieces and \
+            not any(piece.missing for piece in self.ongoing_pieces.values())
+
+    def _endgame_request(self, peer_id) -> Block:
+        """
+        Pick a pending block to request from this peer as well, the one asked
+        from the fewest peers so far. Whichever copy arrives first is used and
+        the other requests are cancelled.
+        """
+        best = None
+        for request in self.pending_blocks.values():
+            if peer_id in request.peers or not self._has_piece(peer_id, request.block.piece):
+                continue
+            if best is None or len(request.peers) < len(best.peers):
+                best = request
+                if len(best.peers) == 1:
+                    break
+        if best is None:
+            return None
+        best.peers.add(peer_id)
+        return best.block
+
     def block_received(self, peer_id, piece_index, block_offset, data, writer):
         """
         when a block is received from a peer. If the hash succeeds the partial piece is written to
         disk and the piece is indicated as Have.
         """
-        print('Received block {block_offset} for piece {piece_index} '
-                      'from peer {peer_id}: '.format(block_offset=block_offset,
-                                                     piece_index=piece_index,
-                                                     peer_id=peer_id))
+        logger.debug('Received block %d for piece %d from peer %s',
+                     block_offset, piece_index, peer_id)
 
-        # Remove from pending requests
-        for index, request in enumerate(self.pending_blocks):
-            if request.block.piece == piece_index and \
-               request.block.offset == block_offset:
-                del self.pending_blocks[index]
-                break
+        # Remove from pending requests, in endgame the other peers we asked
+        # for this block are told not to bother
+        request = self.pending_blocks.get((piece_index, block_offset))
+        if request:
+            for other in request.peers:
+                client = self.connections.get(other)
+                if other != peer_id and client:
+                    client.send_cancel(request.block)
+        self._remove_pending((piece_index, block_offset))
 
-        pieces = [p for p in self.ongoing_pieces if p.index == piece_index]
-        piece = pieces[0] if pieces else None
+        piece = self.ongoing_pieces.get(piece_index)
         if piece:
             piece.block_received(block_offset, data)
-            if piece.is_complete():
-                if piece.is_hash_matching():
-                    self.result.append(piece)
-                    self.ongoing_pieces.remove(piece)
-                    self.have_pieces.append(piece)
-
-                    # every time we receive a piece, announce to our peers
-                    # that we have this piece
-                    """
-                    writer.write(Have.encode(piece))
-                    await writer.drain()
-                    """
-                else:
-                    print('Discarding corrupt piece {index}'
-                                 .format(index=piece.index))
-                    piece.reset()
+            if piece.is_complete() and piece.index not in self.verifying:
+                # hash (and write) the piece on the worker pool, the result is
+                # handled back on the event loop by _piece_verified
+                loop = asyncio.get_event_loop()
+                future = loop.run_in_executor(self.hash_pool, self._verify_and_write, piece)
+                self.verifying[piece.index] = future
+                future.add_done_callback(
+                    lambda f, piece=piece: self._piece_verified(piece, f))
         else:
-            print('Trying to update piece that is not ongoing!')
+            # e.g. a late duplicate in endgame
+            logger.debug('Received block %d for piece %d that is not ongoing',
+                         block_offset, piece_index)
+
+    def _verify_and_write(self, piece) -> bool:
+        """
+        Runs on the hash pool: checks the piece hash and, when it matches,
+        writes the piece to disk. hashlib and pwritev release the GIL so
+        several pieces are processed in parallel with the network I/O.
+        """
+        if not piece.is_hash_matching():
+            return False
+        self.storage.write(piece.index, 0, [piece.data])
+        return True
+
+    def _piece_verified(self, piece, future):
+        """
+        Called on the event loop once the hash pool is done with `piece`
+        """
+        del self.verifying[piece.index]
+        if future.cancelled():
+            return
+        try:
+            verified = future.result()
+        except Exception:
+            # e.g. the disk is full: download the piece again rather than
+            # leaving it stuck with every block retrieved
+            logger.exception('Writing piece %d failed', piece.index)
+            piece.reset()
+            self._wake_peers()
+            return
+        if verified:
+            piece.release()
+            del self.ongoing_pieces[piece.index]
+            self.have[piece.index] = True
+            self.have_count += 1
+            self.downloaded += piece.length
+            self.metrics.pieces_completed += 1
+
+            # every time we receive a piece, announce to our peers
+            # that we have this piece
+            for client in list(self.connections.values()):
+                client.send_have(piece.index)
+            if self.complete:
+                # nothing left to ask anyone for
+                for client in list(self.connections.values()):
+                    client.not_interested()
+                self.completed.set()
+        else:
+            logger.warning('Discarding corrupt piece %d', piece.index)
+            self.metrics.hash_failures += 1
+            piece.reset()
+            self._wake_peers()
+
+    async def flush(self):
+        """
+        Wait for the pieces that are still being verified
+        """
+        if self.verifying:
+            await asyncio.wait(list(self.verifying.values()))
 
-                            
+
+    def release_block(self, piece_index, block_offset, peer_id=None):
+        """
+        A request for this block will never be answered (the peer choked us
+        or disconnected), put the block back to Missing so that the next
+        call to next_request can hand it out again. In endgame the block
+        stays pending while other peers were asked for it too.
+        """
+        request = self.pending_blocks.get((piece_index, block_offset))
+        if request and peer_id is not None:
+            request.peers.discard(peer_id)
+            if request.peers:
+                return
+        self._remove_pending((piece_index, block_offset))
+
+        piece = self.ongoing_pieces.get(piece_index)
+        if piece and piece.block_released(block_offset):
+            self._wake_peers()
+
+    def _add_pending(self, block, peer_id):
+        """
+        Records a request for `block` to `peer_id` and schedules its expiry on
+        the timer wheel, replacing any earlier request of the same block
+        """
+        key = (block.piece, block.offset)
+        # peers asked before are kept, they still get a Cancel if it arrives
+        earlier = self.pending_blocks.get(key)
+        peers = earlier.peers if earlier else set()
+        peers.add(peer_id)
+        self._remove_pending(key)
+        slot = math.ceil((time.monotonic() + self.max_pending_time) / TIMER_RESOLUTION)
+        self.pending_blocks[key] = PendingRequest(block, slot, peers)
+        self.pending_timers.setdefault(slot, set()).add(key)
+
+    def _remove_pending(self, key):
+        """
+        Forgets the pending request for `key` (piece index, block offset), if any
+        """
+        request = self.pending_blocks.pop(key, None)
+        if request:
+            timers = self.pending_timers.get(request.slot)
+            if timers is not None:
+                timers.discard(key)
+                if not timers:
+                    del self.pending_timers[request.slot]
+        self.expired_blocks.pop(key, None)
 
     def _expired_requests(self, peer_id) -> Block:
         """
         Go through previously requested blocks, if any one have been in the
         requested state for longer than `MAX_PENDING_TIME` return the block to
         be re-requested.
+        Only the timer wheel slots that elapsed since the last call are looked
+        at, so the cost is proportional to the number of expired requests.
         If no pending blocks exist, None is returned
         """
-        current = int(round(time.time() * 1000))
-        for request in self.pending_blocks:
-            if self.peers[peer_id][request.block.piece]:
-                if request.added + self.max_pending_time < current:
-                    print('Re-requesting block {block} for '
-                                 'piece {piece}'.format(
-                                    block=request.block.offset,
-                                    piece=request.block.piece))
-                    # Reset expiration timer
-                    request.added = current
-                    return request.block
+        current = int(time.monotonic() // TIMER_RESOLUTION)
+        if self.pending_timers and self.timer_slot <= current:
+            if current - self.timer_slot < len(self.pending_timers):
+                due = range(self.timer_slot, current + 1)
+            else:
+                due = [slot for slot in self.pending_timers if slot <= current]
+            for slot in due:
+                for key in self.pending_timers.pop(slot, ()):
+                    self.expired_blocks[key] = self.pending_blocks[key].block
+        self.timer_slot = current + 1
+
+        for key, block in self.expired_blocks.items():
+            # the peers that left the block hanging are not asked again
+            if self._has_piece(peer_id, block.piece) and \
+               peer_id not in self.pending_blocks[key].peers:
+                logger.debug('Re-requesting block %d for piece %d',
+                             block.offset, block.piece)
+                # next_request resets the expiration timer
+                del self.expired_blocks[key]
+                return block
         return None
 
     def _next_ongoing(self, peer_id) -> Block:
@@ -308,217 +710,60 @@ class Piecetracker:
         Go through the ongoing pieces and return the next block to be
         requested or None if no block is left to be requested.
         """
-        for piece in self.ongoing_pieces:
-            if self.peers[peer_id][piece.index]:
+        for piece in self.ongoing_pieces.values():
+            if self._has_piece(peer_id, piece.index):
                 # Is there any blocks left to request in this piece?
                 block = piece.next_request()
                 if block:
-                    self.pending_blocks.append(
-                        PendingRequest(block, int(round(time.time() * 1000))))
                     return block
         return None
 
     def _get_rarest_piece(self, peer_id):
         """
         go through our missing pieces and find the 
-        rarest one -> the one that the fewest peer have
-        """
-        piece_count = defaultdict(int)
-        for piece in self.missing_pieces:
-            if not self.peers[peer_id][piece.index]:
-                continue
-            for p in self.peers:
-                if self.peers[p][piece.index]:
-                    piece_count[piece] += 1
-        
-        if len(piece_count) == 0:
+        rarest one -> the one that the fewest peer have.
+        The rarity buckets are walked from the rarest up, so the first piece
+        this peer has is the answer; for a peer having a fair share of the
+        pieces we lack that is found after a few lookups, regardless of the
+        number of pieces and peers. A peer having only a handful of them is
+        looked at from its side.
+        """
+        interesting = self.interesting.get(peer_id, 0)
+        if not interesting:
             return None
-        else:
-            rarest_piece = min(piece_count, key=lambda p: piece_count[p])
-            self.missing_pieces.remove(rarest_piece)
-            self.ongoing_pieces.append(rarest_piece)
-            return rarest_piece
+        if interesting * 8 < len(self.missing_pieces):
+            # a peer with only a few pieces we need: pick the rarest of those
+            candidates = [i for i in self.peers[peer_id].indices() if i in self.missing_pieces]
+            return self._start_piece(min(candidates, key=lambda i: self.availability[i]))
+
+        # bucket 0 holds the pieces no peer has, so this peer doesn't either
+        while self.rarest not in self.rarity and self.rarest <= len(self.peers):
+            self.rarest += 1
+        for count in range(self.rarest, len(self.peers) + 1):
+            for index in self.rarity.get(count, ()):
+                if self._has_piece(peer_id, index):
+                    return self._start_piece(index)
+        return None
+
+    def _start_piece(self, index):
+        """
+        Move piece `index` from missing to ongoing
+        """
+        self._leave_missing(index)
+        piece = self._new_piece(index)
+        self.ongoing_pieces[index] = piece
+        return piece
 
     def _next_missing(self, peer_id) -> Block:
         """
         Go through the missing pieces and return the next block to request
         or None if no block is left to be requested, also change missing state to ongoing
         """
-        for index, piece in enumerate(self.missing_pieces):
-            if self.peers[peer_id][piece.index]:
+        for index in list(self.missing_pieces):
+            if self._has_piece(peer_id, index):
                 # Move this piece from missing to ongoing
-                piece = self.missing_pieces.pop(index)
-                self.ongoing_pieces.append(piece)
+                piece = self._start_piece(index)
                 # The missing pieces does not have any previously requested
                 # blocks (then it is ongoing).
                 return piece.next_request()
         return None
-
-    def populate_file_info(self) -> {}:
-        idx = 0
-        result = {}
-        """
-        length:             file_info[curr_file_idx][0] 
-        num pieces:         file_info[curr_file_idx][1] 
-        num pieces written: file_info[curr_file_idx][2] 
-        num blocks written: file_info[curr_file_idx][3]
-        num bytes written:  file_info[curr_file_idx][4]
-        """
-        for file in self.torrent.files:
-            file_pieces = (file.length / self.torrent.piece_length)
-            result[idx] = [file.length, file_pieces, 0, 0, 0]
-            idx += 1
-            #result.append(File(file.length, file_pieces, 0, 0, 0))
-            #print('this file {} has length: {}, and {} pieces'.format(file.name, file.length, file_pieces))
-        return result
-
-
-    def _write(self):
-        """
-        Write the given piece to disk
-        """
-        print('Finished downloading pieces, writing them to our file!')
-        file_info = self.file_info
-        torrent = self.torrent
-        result = self.result
-        piece_length = self.torrent.piece_length
-        total_pieces = self.total_pieces
-        left_over_data = None
-        left_over_len = None
-        print('\n')
-
-        # single file
-        if len(file_info) == 1:
-            for piece in self.result:
-                pos = piece.index * self.torrent.piece_length
-                os.lseek(self.fd[0], pos, os.SEEK_SET)
-                os.write(self.fd[0], piece.data)
-        # multi-file
-        else:      
-            piece_idx = 0
-            block_idx = 0
-            blocks_per_piece = torrent.piece_length / REQUEST_SIZE
-            
-            for file, info in file_info.items():
-                curr_file_idx = self.curr_file_idx
-                curr_file_length = info[0]
-                curr_file_pieces = info[1]
-                pieces_written = info[2]
-                blocks_written = info[3]
-                bytes_written = info[4]
-
-                #length left initially is the entire file length
-                length_left = curr_file_length
-                print('initial length: {}'.format(length_left))
-
-                if left_over_data is not None and left_over_len is not None:
-                    if length_left < left_over_len:
-                        print('consuming left over (less) of {}'.format(length_left))
-                        os.lseek(self.fd[curr_file_idx], 0, os.SEEK_SET) 
-                        os.write(self.fd[curr_file_idx], left_over_data[0:length_left])
-                        info[4] += length_left
-                        
-                        left_over_data = left_over_data[length_left:]
-                        left_over_len = left_over_len - length_left
-                        length_left = 0     
-                    else:
-                        pos = 0
-                        print('consuming left over of {}'.format(left_over_len))
-                        os.lseek(self.fd[curr_file_idx], pos, os.SEEK_SET) 
-                        os.write(self.fd[curr_file_idx], left_over_data)
-                        pos += left_over_len
-                        block_idx += 1
-
-                        #updating the number of bytes written
-                        info[4] = left_over_len
-                        length_left -= left_over_len
-                        
-                   
-                        # adding the rest of the piece
-                        blocks_written = 0
-                        current_blocks = result[piece_idx].blocks[block_idx:]
-                        if length_left >= (len(current_blocks) * REQUEST_SIZE):
-                            for block in current_blocks:
-                                os.lseek(self.fd[curr_file_idx], pos, os.SEEK_SET) 
-                                os.write(self.fd[curr_file_idx], block.data)
-                                pos += REQUEST_SIZE
-                                # updating the number of blocks written
-                                blocks_written += 1
-                                info[3] += 1
-                            # done with the current piece  
-                            block_idx = 0
-                            print('consumed: {} blocks, info[3] is: {}'.format(blocks_written, info[3]))
-                            length_left -= blocks_written * REQUEST_SIZE
-                            # after finishing with the piece, move on to the next one
-                            piece_idx += 1  
-                        # consumed all of the byte for this block/piece
-                        left_over_data = None
-                        left_over_len = None 
-                   
-
-                while length_left > 0:
-                    num_pieces = math.floor(length_left / piece_length)
-                    print('num pieces to consume: {}'.format(num_pieces))
-
-                    print('current pieces: {}, current blocks {}, current bytes: {}'.format(info[2], info[3], info[4]))
-                    position = (info[2] * piece_length) + (info[3] * REQUEST_SIZE) + info[4]
-                    print('starting postion: {}'.format(position))
-                    print('length left now is {}'.format(length_left))
-                    #writing all of the possible pieces for this file
-                    pieces_written = num_pieces
-                    if num_pieces > 0:
-                        while num_pieces > 0:
-                            os.lseek(self.fd[curr_file_idx], position, os.SEEK_SET) 
-                            os.write(self.fd[curr_file_idx], result[piece_idx].data)
-                            # increment the pieces written
-                            info[2] += 1
-                            piece_idx += 1
-                            num_pieces -= 1
-                            position += piece_length
-                        block_idx = 0
-                        #update the length
-                        length_left -= pieces_written * piece_length
-                        print()
-                        print('length left now is {}'.format(length_left))
-
-
-                    num_blocks = math.floor(length_left / REQUEST_SIZE)
-                    print('num blocks to consume: {}'.format(num_blocks))
-                    #writing all of the possible blocks for this file
-                    blocks_written = num_blocks
-                    if num_blocks > 0:
-                        print('current block idx: {}'.format(block_idx))
-                        while num_blocks > 0:
-                            os.lseek(self.fd[curr_file_idx], position, os.SEEK_SET)
-                            curr_block = result[piece_idx].blocks[block_idx]
-                            os.write(self.fd[curr_file_idx], curr_block.data)
-                            info[3] += 1
-                            block_idx += 1
-                            num_blocks -=1
-                            position += REQUEST_SIZE
-                        #update the length
-                        length_left -= blocks_written * REQUEST_SIZE
-                        print('length left now is {}'.format(length_left))
-
-                    num_bytes = length_left
-                    if num_bytes > 0:
-                        curr_block = result[piece_idx].blocks[block_idx]
-                        os.lseek(self.fd[curr_file_idx], position, os.SEEK_SET)
-                        os.write(self.fd[curr_file_idx], curr_block.data[0:num_bytes])
-                        info[4] += num_bytes
-                        left_over_data = curr_block.data[num_bytes:]  
-                        left_over_len = curr_block.length - num_bytes
-
-                        #left_over_len = result[piece_idx][block_idx].length - num_bytes 
-                        # done with this file 
-                        length_left = 0
-                        print('num bytes left: {}'.format(left_over_len)) 
-                        print('length left now is {}'.format(length_left))    
-
-                    print('the end, file {} has length: {}'.format(curr_file_idx, length_left))
-                    print('\n')
-                
-                if self.curr_file_idx < len(file_info) - 2:
-                    print('incrementing')
-                    self.curr_file_idx += 1
-
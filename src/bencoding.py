@@ -18,101 +18,147 @@ TOKEN_STRING_SEPARATOR = b':'
 class Decoder:
     """
     Decodes a bencoded sequence of bytes.
+
+    The data is walked iteratively with an explicit stack of the lists and
+    dicts being filled, so deeply nested input can't hit the recursion
+    limit. Integers and string lengths are parsed digit by digit straight
+    from a memoryview of the data, without slicing them out first.
+    Strings of `zero_copy_threshold` bytes or more (e.g. the `pieces` of a
+    large torrent) are returned as memoryview slices of the data instead of
+    being copied, by default every string is returned as bytes.
+
+    While decoding, the byte span (start, end) of the value of every key of
+    the outermost dict is recorded in `spans`, e.g. so the info hash of a
+    torrent can be taken over the original bytes of its info dict.
     """
-    def __init__(self, data: bytes):
-        if not isinstance(data, bytes):
+    def __init__(self, data: bytes, zero_copy_threshold: int = None):
+        if not isinstance(data, (bytes, bytearray, memoryview)):
             raise TypeError('Argument "data" must be of type bytes')
-        self._data = data
+        self._data = memoryview(data)
         self._index = 0
+        self.zero_copy_threshold = zero_copy_threshold
+        self.spans = {}
 
     def decode(self):
         """
         Decodes the bencoded data and return the matching python object.
         :return A python object representing the bencoded data
         """
-        c = self._peek()
-        if c is None:
+        data = self._data
+        end = len(data)
+        threshold = self.zero_copy_threshold
+        index = self._index
+        # the lists and dicts being filled, innermost last, and for every
+        # dict on the stack the key waiting for its value (_NO_KEY if none)
+        stack = []
+        keys = []
+        # where the current element of the outermost container started
+        element_start = index
+        try:
+            while True:
+                if len(stack) == 1:
+                    element_start = index
+                c = data[index]
+                if c == _INT:
+                    value, index = self._parse_int(index + 1, _END)
+                elif 0x30 <= c <= 0x39:
+                    # the length prefix, inlined as strings are the most common values
+                    length = c - 0x30
+                    index += 1
+                    c = data[index]
+                    while 0x30 <= c <= 0x39:
+                        length = length * 10 + c - 0x30
+                        index += 1
+                        c = data[index]
+                    if c != _SEPARATOR:
+                        raise RuntimeError('Unable to find token {0}'.format(
+                            str(TOKEN_STRING_SEPARATOR)))
+                    start = index + 1
+                    index = start + length
+                    if index > end:
+                        raise EOFError('Cannot read {0} bytes from current position {1}'
+                                       .format(str(length), str(start)))
+                    if threshold is not None and length >= threshold:
+                        value = data[start:index]
+                    else:
+                        value = data[start:index].tobytes()
+                elif c == _LIST:
+                    stack.append([])
+                    index += 1
+                    continue
+                elif c == _DICT:
+                    stack.append({})
+                    keys.append(_NO_KEY)
+                    index += 1
+                    continue
+                elif c == _END:
+                    index += 1
+                    if not stack:
+                        # an end token where a value was expected
+                        self._index = index - 1
+                        return None
+                    value = stack.pop()
+                    if type(value) is dict:
+                        if keys.pop() is not _NO_KEY:
+                            raise RuntimeError('Dict key without a value at {0}'.format(str(index - 1)))
+                else:
+                    raise RuntimeError('Invalid token read at {0}'.format(
+                        str(index)))
+
+                # hand the value to the container it belongs to
+                if not stack:
+                    self._index = index
+                    return value
+                container = stack[-1]
+                if type(container) is list:
+                    container.append(value)
+                elif keys[-1] is _NO_KEY:
+                    if type(value) is memoryview:
+                        value = value.tobytes()
+                    elif type(value) is not bytes:
+                        raise RuntimeError('Dict keys must be strings, at {0}'.format(str(index)))
+                    keys[-1] = value
+                else:
+                    container[keys[-1]] = value
+                    if len(stack) == 1:
+                        self.spans[keys[-1]] = (element_start, index)
+                    keys[-1] = _NO_KEY
+        except IndexError:
+            # ran off the end of the data in the middle of a value
             raise EOFError('Unexpected end-of-file')
-        elif c == TOKEN_INTEGER:
-            self._consume()  # The token
-            return self._decode_int()
-        elif c == TOKEN_LIST:
-            self._consume()  # The token
-            return self._decode_list()
-        elif c == TOKEN_DICT:
-            self._consume()  # The token
-            return self._decode_dict()
-        elif c == TOKEN_END:
-            return None
-        elif c in b'01234567899':
-            return self._decode_string()
-        else:
-            raise RuntimeError('Invalid token read at {0}'.format(
-                str(self._index)))
 
-    def _peek(self):
+    def _parse_int(self, index: int, token: int):
         """
-        Return the next character from the bencoded data or None
+        Parses the (optionally negative) decimal number at `index`, which
+        must be followed by `token`.
+        :return The number and the index after the token
         """
-        if self._index + 1 >= len(self._data):
-            return None
-        return self._data[self._index:self._index + 1]
+        data = self._data
+        negative = data[index] == _MINUS
+        if negative:
+            index += 1
+        start = index
+        value = 0
+        c = data[index]
+        while 0x30 <= c <= 0x39:
+            value = value * 10 + c - 0x30
+            index += 1
+            c = data[index]
+        if c != token or index == start:
+            raise RuntimeError('Unable to find token {0}'.format(
+                str(bytes([token]))))
+        return (-value if negative else value), index + 1
 
-    def _consume(self) -> bytes:
-        """
-        Read (and therefore consume) the next character from the data
-        """
-        self._index += 1
 
-    def _read(self, length: int) -> bytes:
-        """
-        Read the `length` number of bytes from data and return the result
-        """
-        if self._index + length > len(self._data):
-            raise IndexError('Cannot read {0} bytes from current position {1}'
-                             .format(str(length), str(self._index)))
-        res = self._data[self._index:self._index+length]
-        self._index += length
-        return res
-
-    def _read_until(self, token: bytes) -> bytes:
-        """
-        Read from the bencoded data until the given token is found and return
-        the characters read.
-        """
-        try:
-            occurrence = self._data.index(token, self._index)
-            result = self._data[self._index:occurrence]
-            self._index = occurrence + 1
-            return result
-        except ValueError:
-            raise RuntimeError('Unable to find token {0}'.format(
-                str(token)))
-
-    def _decode_int(self):
-        return int(self._read_until(TOKEN_END))
-
-    def _decode_list(self):
-        res = []
-        # Recursive decode the content of the list
-        while self._data[self._index: self._index + 1] != TOKEN_END:
-            res.append(self.decode())
-        self._consume()  # The END token
-        return res
-
-    def _decode_dict(self):
-        res = OrderedDict()
-        while self._data[self._index: self._index + 1] != TOKEN_END:
-            key = self.decode()
-            obj = self.decode()
-            res[key] = obj
-        self._consume()  # The END token
-        return res
-
-    def _decode_string(self):
-        bytes_to_read = int(self._read_until(TOKEN_STRING_SEPARATOR))
-        data = self._read(bytes_to_read)
-        return data
+# the tokens as byte values, for comparing against items of a memoryview
+_INT = TOKEN_INTEGER[0]
+_LIST = TOKEN_LIST[0]
+_DICT = TOKEN_DICT[0]
+_END = TOKEN_END[0]
+_SEPARATOR = TOKEN_STRING_SEPARATOR[0]
+_MINUS = ord('-')
+# marks a dict on the decoder stack that is waiting for a key
+_NO_KEY = object()
 
 
 class Encoder:
@@ -123,62 +169,82 @@ class Encoder:
         - int
         - list
         - dict
-        - bytes
+        - bytes (and bytearray / memoryview)
     Any other type will simply be ignored.
+
+    Everything is written into a single buffer, which `write` streams out to
+    a file object whenever it grows past `chunk_size`.
     """
-    def __init__(self, data):
+    def __init__(self, data, chunk_size: int = 2**16):
         self._data = data
+        self.chunk_size = chunk_size
+        self._buffer = bytearray()
+        self._out = None
 
     def encode(self) -> bytes:
         """
         Encode a python object to a bencoded binary string
         :return The bencoded binary data
         """
-        return self.encode_next(self._data)
+        self._buffer = bytearray()
+        self._out = None
+        if not self._encode_next(self._data):
+            return None
+        return bytes(self._buffer)
 
-    def encode_next(self, data):
+    def write(self, out) -> None:
+        """
+        Encode a python object straight into the binary file object `out`
+        """
+        self._buffer = bytearray()
+        self._out = out
+        self._encode_next(self._data)
+        self._flush()
+        self._out = None
+
+    def _flush(self):
+        if self._out is not None and self._buffer:
+            self._out.write(self._buffer)
+            self._buffer = bytearray()
+
+    def _encode_next(self, data) -> bool:
+        """
+        Append the encoding of `data` to the buffer
+        :return False if the type of `data` is not supported
+        """
         if type(data) == str:
-            return self._encode_string(data)
+            self._encode_bytes(data.encode('utf-8'))
         elif type(data) == int:
-            return self._encode_int(data)
+            self._buffer += b'i%de' % data
         elif type(data) == list:
-            return self._encode_list(data)
+            self._encode_list(data)
         elif type(data) == dict or type(data) == OrderedDict:
-            return self._encode_dict(data)
-        elif type(data) == bytes:
-            return self._encode_bytes(data)
+            self._encode_dict(data)
+        elif type(data) in (bytes, bytearray, memoryview):
+            self._encode_bytes(data)
         else:
-            return None
-
-    def _encode_int(self, value):
-        return str.encode('i' + str(value) + 'e')
+            return False
+        if self._out is not None and len(self._buffer) >= self.chunk_size:
+            self._flush()
+        return True
 
-    def _encode_string(self, value: str):
-        res = str(len(value)) + ':' + value
-        return str.encode(res)
-
-    def _encode_bytes(self, value: str):
-        result = bytearray()
-        result += str.encode(str(len(value)))
-        result += b':'
-        result += value
-        return result
+    def _encode_bytes(self, value: bytes):
+        self._buffer += b'%d:' % len(value)
+        self._buffer += value
 
     def _encode_list(self, data):
-        result = bytearray('l', 'utf-8')
-        result += b''.join([self.encode_next(item) for item in data])
-        result += b'e'
-        return result
-
-    def _encode_dict(self, data: dict) -> bytes:
-        result = bytearray('d', 'utf-8')
+        self._buffer += b'l'
+        for item in data:
+            if not self._encode_next(item):
+                raise RuntimeError('Bad list')
+        self._buffer += b'e'
+
+    def _encode_dict(self, data: dict):
+        self._buffer += b'd'
         for k, v in data.items():
-            key = self.encode_next(k)
-            value = self.encode_next(v)
-            if key and value:
-                result += key
-                result += value
-            else:
+            if type(k) is not str and type(k) is not bytes:
+                raise RuntimeError('Bad dict')
+            self._encode_next(k)
+            if not self._encode_next(v):
                 raise RuntimeError('Bad dict')
-        result += b'e'
-        return result
\ No newline at end of file
+        self._buffer += b'e'
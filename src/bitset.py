@@ -0,0 +1,113 @@
+class BitSet:
+    """
+    A fixed-length array of bits packed 8 to a byte, in the same layout as
+    the bitfield message: the high bit of the first byte is piece 0.
+    Set operations between bitsets run on whole integers instead of bit by bit.
+    """
+    def __init__(self, length: int):
+        self.length = length
+        self._bytes = bytearray((length + 7) // 8)
+
+    @classmethod
+    def from_bytes(cls, data: bytes, length: int = None):
+        """
+        Builds a bitset from wire bytes. Without a length every bit of `data`
+        is used, otherwise bits past `length` (the spare bits of the last
+        byte) are dropped.
+        """
+        if length is None:
+            length = len(data) * 8
+        bitset = cls(length)
+        size = len(bitset._bytes)
+        bitset._bytes[:] = bytes(data[:size]).ljust(size, b'\x00')
+        bitset._clear_padding()
+        return bitset
+
+    def to_bytes(self) -> bytes:
+        """
+        The bits in wire format, ready for a bitfield message
+        """
+        return bytes(self._bytes)
+
+    def truncate(self, length: int):
+        """
+        Shrinks the bitset to `length` bits (the number of pieces once the
+        bitset came from a bitfield message of unknown size)
+        """
+        if length < self.length:
+            self.length = length
+            del self._bytes[(length + 7) // 8:]
+            self._clear_padding()
+
+    def _clear_padding(self):
+        spare = len(self._bytes) * 8 - self.length
+        if spare:
+            self._bytes[-1] &= (0xff << spare) & 0xff
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, index: int) -> bool:
+        if not 0 <= index < self.length:
+            raise IndexError('bit index {} out of range'.format(index))
+        return bool(self._bytes[index >> 3] & (0x80 >> (index & 7)))
+
+    def __setitem__(self, index: int, value: bool):
+        if not 0 <= index < self.length:
+            raise IndexError('bit index {} out of range'.format(index))
+        if value:
+            self._bytes[index >> 3] |= 0x80 >> (index & 7)
+        else:
+            self._bytes[index >> 3] &= ~(0x80 >> (index & 7)) & 0xff
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, BitSet) and self.length == other.length \
+            and self._bytes == other._bytes
+
+    def _int(self) -> int:
+        return int.from_bytes(self._bytes, 'big')
+
+    def _from_int(self, value: int):
+        result = BitSet(self.length)
+        result._bytes[:] = value.to_bytes(len(self._bytes), 'big')
+        return result
+
+    def _check_length(self, other):
+        # bits are compared by position, a shorter bitset would be misaligned
+        if self.length != other.length:
+            raise ValueError('bitsets of {} and {} bits'.format(self.length, other.length))
+
+    def difference(self, other):
+        """
+        Bits set here but not in `other`, e.g. "the peer has and we lack"
+        """
+        self._check_length(other)
+        return self._from_int(self._int() & ~other._int())
+
+    def __and__(self, other):
+        self._check_length(other)
+        return self._from_int(self._int() & other._int())
+
+    def __or__(self, other):
+        self._check_length(other)
+        return self._from_int(self._int() | other._int())
+
+    def any(self) -> bool:
+        return any(self._bytes)
+
+    def count(self) -> int:
+        """
+        Number of bits set
+        """
+        return bin(self._int()).count('1')
+
+    def indices(self):
+        """
+        Yields the index of every bit set, skipping empty bytes
+        """
+        for byte_index, byte in enumerate(self._bytes):
+            if byte:
+                base = byte_index << 3
+                for bit in range(8):
+                    if byte & (0x80 >> bit):
+                        yield base + bit
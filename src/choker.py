@@ -0,0 +1,102 @@
+import asyncio
+import random
+import time
+
+# how often (in seconds) the unchoked peers are re-evaluated
+RECHOKE_INTERVAL = 10
+# how often the optimistic unchoke moves on to another peer
+OPTIMISTIC_INTERVAL = 30
+# number of peers unchoked for their rate (the optimistic one comes on top)
+UPLOAD_SLOTS = 4
+
+
+class Choker:
+    """
+    Tit-for-tat choking: every RECHOKE_INTERVAL seconds the interested peers
+    are ranked by the rate they gave us since the last round (the rate we
+    upload to them once we are seeding, then there is nothing to receive)
+    and the best `slots` are unchoked. One more, randomly picked, peer is
+    unchoked optimistically and rotated every OPTIMISTIC_INTERVAL seconds, so
+    new peers get a chance to show what they can do.
+    """
+    def __init__(self, pieceTracker, slots: int = UPLOAD_SLOTS,
+                 interval: float = RECHOKE_INTERVAL,
+                 optimistic_interval: float = OPTIMISTIC_INTERVAL):
+        self.pieceTracker = pieceTracker
+        self.slots = slots
+        self.interval = interval
+        self.optimistic_interval = optimistic_interval
+        self.optimistic = None
+        self._optimistic_since = 0
+        # client -> (downloaded, uploaded) at the last round
+        self._last = {}
+        self._last_time = time.monotonic()
+
+    async def run(self):
+        """
+        Re-evaluates the unchoked peers every interval, for as long as it runs
+        """
+        while True:
+            self.rechoke()
+            await asyncio.sleep(self.interval)
+
+    def _rates(self, clients) -> dict:
+        """
+        Rate of every client since the last round, in bytes per second
+        """
+        now = time.monotonic()
+        elapsed = max(now - self._last_time, 1e-3)
+        seeding = self.pieceTracker.complete
+        rates = {}
+        last = {}
+        for client in clients:
+            downloaded, uploaded = self._last.get(client, (client.downloaded, client.uploaded))
+            if seeding:
+                rates[client] = (client.uploaded - uploaded) / elapsed
+            else:
+                rates[client] = (client.downloaded - downloaded) / elapsed
+            last[client] = (client.downloaded, client.uploaded)
+        self._last = last
+        self._last_time = now
+        return rates
+
+    def rechoke(self):
+        """
+        Unchoke the fastest interested peers plus the optimistic one, choke
+        everyone else
+        """
+        clients = list(self.pieceTracker.connections.values())
+        rates = self._rates(clients)
+        interested = [client for client in clients if client.peer_interested]
+        interested.sort(key=lambda client: rates[client], reverse=True)
+
+        now = time.monotonic()
+        rotate = self.optimistic not in interested or \
+            now - self._optimistic_since >= self.optimistic_interval
+        if rotate:
+            self.optimistic = None
+        # the optimistic unchoke doesn't take one of the regular slots
+        unchoked = set([client for client in interested
+                        if client is not self.optimistic][:self.slots])
+        if rotate:
+            candidates = [client for client in interested if client not in unchoked]
+            self.optimistic = random.choice(candidates) if candidates else None
+            self._optimistic_since = now
+        if self.optimistic is not None:
+            unchoked.add(self.optimistic)
+
+        for client in clients:
+            if client in unchoked:
+                client.unchoke()
+            else:
+                client.choke()
+
+    def interested(self, client):
+        """
+        A peer became interested, unchoke it right away if a slot is free
+        instead of keeping it waiting for the next round
+        """
+        unchoked = sum(1 for other in self.pieceTracker.connections.values()
+                       if not other.am_choking)
+        if unchoked < self.slots + 1:
+            client.unchoke()
@@ -1,17 +1,24 @@
 import asyncio
+import logging
 import struct
 import random
 import string
 import os
+import math
+import time
 
+from collections import deque
 from hashlib import sha1
+from struct import unpack_from
 from typing import List
 from torrent import Torrent 
-from concurrent.futures import CancelledError
+from asyncio import CancelledError
 from MessageType import Unchoke, Choke, Interested, NotInterested, Have, Bitfield, KeepAlive, Cancel, Piece, Request
 from Piecetracker import Piece as piece, Block, Piecetracker
-# 2**14 = 10 * 1024 bytes
-REQUEST_SIZE = 10*1024
+logger = logging.getLogger(__name__)
+
+# 2**14 = 16 * 1024 bytes
+REQUEST_SIZE = 2**14
 
 # diffrent message ID
 CHOKE = 0
@@ -25,10 +32,46 @@ PIECE = 7
 CANCEL = 8
 PORT = 9
 
+# how many bytes PeerStream asks the socket for per read
+CHUNK_SIZE = 2**18
+
+# number of requests kept in flight per peer when pipelining
+PIPELINE_DEPTH = 5
+# bounds for the adaptive request window
+MIN_PIPELINE_DEPTH = 2
+MAX_PIPELINE_DEPTH = 250
+# how often (in seconds) the adaptive window re-estimates the peer's download rate
+RATE_INTERVAL = 1.0
+# how far above the estimated bandwidth-delay product the adaptive window is allowed to grow
+WINDOW_HEADROOM = 1.5
+
+# largest block we serve to a peer, bigger requests are ignored
+MAX_REQUEST_SIZE = 2**17
+# most block requests of a peer we queue, the ones beyond are ignored
+MAX_UPLOAD_QUEUE = 250
+
+# longest message a peer may send (a Piece of the largest block), the
+# bitfield of a torrent with many pieces may be longer
+MAX_MESSAGE_LENGTH = MAX_REQUEST_SIZE + 9
+# message id -> exact length (id included) of the fixed size messages
+MESSAGE_LENGTHS = {CHOKE: 1, UNCHOKE: 1, INTERESTED: 1, NOTINTERESTED: 1,
+                   HAVE: 5, REQUEST: 13, CANCEL: 13, PORT: 3}
+
+# seconds to wait for the TCP connection and for the peer's handshake
+CONNECT_TIMEOUT = 10
+HANDSHAKE_TIMEOUT = 10
+
 class Client:
     # instantiate 
     #piece tracker is for tracking all of our pieces, what each peers have in terms of pieces, and what we need
-    def __init__(self, torrent, pieceTracker, peer_id, remote_id, ip, port):
+    #pipeline_depth is how many requests we keep outstanding with this peer, with adaptive=True
+    #it is only the starting point and the window follows the bandwidth-delay product of the connection
+    #block_reader (a storage.ReadCache) serves the blocks the peer asks us for, without it we don't upload.
+    #rate_limiter is shared by all clients to cap our total upload rate.
+    #choker decides which peers we upload to, without one every interested peer is unchoked
+    def __init__(self, torrent, pieceTracker, peer_id, remote_id, ip, port,
+                 pipeline_depth: int = PIPELINE_DEPTH, adaptive: bool = False,
+                 block_reader=None, rate_limiter=None, choker=None):
         self.torrent = torrent
         self.pieceTracker = pieceTracker
         self.ip = ip
@@ -37,6 +80,43 @@ class Client:
         self.remote_id = remote_id
         self.str_id = str(self.ip) + ':' + str(self.port)
 
+        # request pipelining state
+        self.adaptive = adaptive
+        self.window = max(1, pipeline_depth)
+        # (piece index, block offset) -> time the request was sent
+        self.outstanding = {}
+        # smallest request -> piece latency seen so far, our estimate of the round trip time
+        self.min_rtt = None
+        # download rate from this peer in bytes per second
+        self.rate = 0.0
+        self._rate_bytes = 0
+        self._rate_start = time.monotonic()
+
+        # our initial state is choked
+        self.isChoke = True
+        self.isInterested = False
+        # set whenever it may be possible to send more requests to this peer
+        self._can_request = asyncio.Event()
+
+        # uploading state, the peer starts out choked by us
+        self.am_choking = True
+        self.peer_interested = False
+        self.block_reader = block_reader
+        self.rate_limiter = rate_limiter
+        self.choker = choker
+        # requests of the peer waiting to be served
+        self.upload_queue = deque()
+        self._can_upload = asyncio.Event()
+
+        # bytes received from / sent to this peer
+        self.downloaded = 0
+        self.uploaded = 0
+        self.writer = None
+        # set once the handshake went through
+        self.connected = False
+        # metrics of the session, see metrics.PeerStats
+        self.stats = None
+
     # constructing the handshake
     def handshakeBuf(self):
         #if its a string
@@ -55,8 +135,7 @@ class Client:
         Decodes the given BitTorrent message into a handshake message, if not
         a valid message, None is returned.
         """
-        print('Decoding Handshake of length: {length}'.format(
-            length=len(data)))
+        logger.debug('Decoding Handshake of length: %d', len(data))
         if len(data) < 68:
             return None
         parts = struct.unpack('>B19s8x20s20s', data)
@@ -73,114 +152,197 @@ class Client:
         pstr = "BitTorrent protocol".
         49 + len(pstr) = 68 bytes long."""
 
-        data = b''
-        tries = 1
-        data = await reader.read(68)
-
-        while len(data) < 68:
-            extra = await reader.read(68 - len(data))
-            data += extra
+        try:
+            data = await reader.readexactly(68)
+        except asyncio.IncompleteReadError:
+            raise ConnectionError('Unable receive and parse a handshake')
 
-        # validating the handshake
+        # validating the handshake, a bad one only ends this connection
         res = self.decode_handshake(data)
         if res is None:
-            print('Unable receive and parse a handshake')
-            exit(1)
+            raise ConnectionError('Unable receive and parse a handshake')
         if not res[2] == self.torrent.info_hash:
-            print('Handshake with invalid info_hash')
-            exit(1)
+            raise ConnectionError('Handshake with invalid info_hash')
 
-    async def _request_piece(self, writer) -> bool:
-        block = self.pieceTracker.next_request(self.remote_id)
-        if block:
+    async def _request_piece(self, writer) -> int:
+        """
+        Fill the request pipeline: keep sending requests until `self.window`
+        requests are outstanding with this peer or the piece tracker has
+        nothing left for it.
+        Returns:
+            int: number of requests sent
+        """
+        sent = 0
+        while len(self.outstanding) < self.window:
+            block = self.pieceTracker.next_request(self.remote_id)
+            if not block:
+                break
+            key = (block.piece, block.offset)
+            if key in self.outstanding:
+                # already waiting on this one from this peer
+                break
             message = Request(block.piece, block.offset, block.length).encode()
 
-            print('Requesting block {block} for piece {piece} '
-                            'of {length} bytes from peer {peer}'.format(
-                            piece=block.piece,
-                            block=block.offset,
-                            length=block.length,
-                            peer=self.remote_id))
+            logger.debug('Requesting block %d for piece %d of %d bytes from peer %s',
+                         block.offset, block.piece, block.length, self.remote_id)
 
             writer.write(message)
+            self.outstanding[key] = time.monotonic()
+            sent += 1
+
+        if sent:
+            self.stats.in_flight = len(self.outstanding)
+            # one drain for the whole batch of requests
             await writer.drain()
-            return 1
-        else:
-            return 0
+        return sent
+
+    def _piece_arrived(self, index: int, begin: int, length: int):
+        """
+        Bookkeeping for a received block: frees its slot in the pipeline and,
+        in adaptive mode, updates the window from the rate and latency samples.
+        """
+        now = time.monotonic()
+        sent_at = self.outstanding.pop((index, begin), None)
+        stats = self.stats
+        stats.bytes_in += length
+        stats.in_flight = len(self.outstanding)
+        if sent_at is not None:
+            latency = now - sent_at
+            stats.latency.observe(latency)
+            if self.min_rtt is None or latency < self.min_rtt:
+                self.min_rtt = latency
+
+        self._rate_bytes += length
+        elapsed = now - self._rate_start
+        if elapsed >= RATE_INTERVAL:
+            self.rate = self._rate_bytes / elapsed
+            self._rate_bytes = 0
+            self._rate_start = now
+            if self.adaptive:
+                self._adapt_window()
+
+    def _adapt_window(self):
+        """
+        Move the request window toward the bandwidth-delay product of this
+        connection. While the window is what limits us the measured rate keeps
+        up with it and the window grows geometrically, once the link is the
+        limit it settles at WINDOW_HEADROOM times the BDP.
+        """
+        if not self.min_rtt or not self.rate:
+            return
+        bdp_blocks = (self.rate * self.min_rtt) / REQUEST_SIZE
+        target = math.ceil(bdp_blocks * WINDOW_HEADROOM) + 1
+        self.window = max(MIN_PIPELINE_DEPTH, min(MAX_PIPELINE_DEPTH, target))
+
+    def _release_outstanding(self):
+        """
+        Hand every request still in flight with this peer back to the piece
+        tracker, the peer will not answer them (choked us or went away).
+        """
+        for index, begin in self.outstanding:
+            self.pieceTracker.release_block(index, begin, self.remote_id)
+        self.outstanding.clear()
 
     async def start(self):
-        reader = None
-        writer = None
-        try:
-            print("connecting to: " + str(self.ip)+ " "+ str(self.port))
+        """
+        Connects to the peer and runs the session with it
+        """
+        async def connect():
+            logger.debug('connecting to: %s', self.str_id)
             #wait for at most 10 seconds
-            reader, writer = await asyncio.open_connection(self.ip, self.port)
-            print('succesfully made connection with Peer {}:{}'.format(self.ip, self.port))
+            reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(self.ip, self.port), CONNECT_TIMEOUT)
+            logger.debug('succesfully made connection with Peer %s', self.str_id)
 
             #handshake
-            await self._handshake(reader, writer)
-            print('Succesfull handshake with Peer {}:{}'.format(self.ip, self.port))
+            await asyncio.wait_for(self._handshake(reader, self.writer), HANDSHAKE_TIMEOUT)
+            logger.info('Succesfull handshake with Peer %s', self.str_id)
+            return reader
 
-            # our initial state is choked
-            isChoke = True
+        await self._run(connect)
 
-            """
-            #sending our peers the bitfield message
-            bitfield = self.pieceTracker.return_bitfield()
-            writer.write(Bitfield.encode(data=bitfield))
+    async def serve(self, reader, writer):
+        """
+        Runs the session of a connection the peer opened to us. Its handshake
+        was already read and checked by the PeerServer, we answer with ours.
+        """
+        async def accept():
+            self.writer = writer
+            writer.write(self.handshakeBuf())
             await writer.drain()
-            print('sent a bitfield message')
+            logger.info('Accepted connection from Peer %s', self.str_id)
+            return reader
 
-            #sending unchoke messages back to peers
-            unchoke = struct.pack('>Ib', 1, UNCHOKE)
-            writer.write(unchoke)
-            await writer.drain()
-            print('sent unchoke message')
-            """
+        await self._run(accept)
 
-            # sending back interest message -> let peer know we want to download
-            msg = struct.pack('>Ib', 1, 2)
-            writer.write(msg)
+    async def _run(self, open_session):
+        """
+        The session with the peer, shared by outgoing and incoming
+        connections. `open_session` sets up the connection up to and including
+        the handshake and returns the reader.
+        """
+        requester = None
+        uploader = None
+        try:
+            reader = await open_session()
+            writer = self.writer
+            self.connected = True
+            self.stats = self.pieceTracker.metrics.peer(self.remote_id, self.str_id)
+
+            #sending our peers the bitfield message
+            if self.pieceTracker.have_count:
+                writer.write(Bitfield.encode(data=self.pieceTracker.return_bitfield()))
+                logger.debug('sent a bitfield message to Peer %s', self.str_id)
+
+            # sending interest message -> let peer know we want to download
+            if not self.pieceTracker.complete:
+                writer.write(Interested().encode())
+                self.isInterested = True
             await writer.drain()
-            isInterested = True
 
-            received_piece = False
+            # requests are sent from their own task so that work freed up
+            # elsewhere (a failed hash, another peer leaving) reaches idle peers
+            self.pieceTracker.add_connection(self)
+            requester = asyncio.ensure_future(self._request_loop(writer))
+            requester.add_done_callback(self._task_done)
+            if self.block_reader:
+                uploader = asyncio.ensure_future(self._upload_loop())
+                uploader.add_done_callback(self._task_done)
+
             """
             Each message's structure: <message ID><payload>
             The `message ID` is a decimal byte
             The `payload` is the value of `length prefix`
             """
 
-            buf = b''
-            async for message in PeerStream(reader, buf):
+            # the bitfield is the only message whose size depends on the torrent
+            max_length = max(MAX_MESSAGE_LENGTH, 1 + math.ceil(self.pieceTracker.total_pieces / 8))
+            async for message in PeerStream(reader, max_length=max_length):
                 if type(message) is Choke:
-                    isChoke = True
+                    self.isChoke = True
+                    self.stats.choked()
+                    # a choking peer drops all of our pending requests
+                    self._release_outstanding()
                 elif type(message) is Unchoke:
-                    isChoke = False
+                    self.isChoke = False
+                    self.stats.unchoked()
                 elif type(message) is Interested:
-                    isInterested = True
+                    self.peer_interested = True
+                    if self.block_reader and self.am_choking:
+                        if self.choker:
+                            self.choker.interested(self)
+                        else:
+                            self.unchoke()
                 elif type(message) is NotInterested:
-                    isInterested = False
+                    self.peer_interested = False
                 elif type(message) is Piece:
-                    received_piece = False
+                    self.downloaded += len(message.block)
+                    self._piece_arrived(message.index, message.begin, len(message.block))
                     self.pieceTracker.block_received(
                         peer_id=self.remote_id, piece_index=message.index,
                         block_offset=message.begin, data=message.block, writer=writer)
-                    
-                    # every time we recieve a piece, send a have message to this piece
-
                 elif type(message) is Request:
-                    """
-                    print('sending back request index: {index}, begin:{begin}, '
-                                    'length: {length}'.format(
-                                    index=message.index,
-                                    begin=message.begin,
-                                    length=message.length))
-                    piece_requested = self.pieceTracker.have_pieces[index][begin]
-                    writer.write(Piece.encode(piece_requested))
-                    await writer.drain()
-                    """
-                    pass
+                    self._queue_upload(message)
                 elif type(message) is Bitfield:
                     self.pieceTracker.add_peer(self.remote_id,
                                                     message.bitfield)
@@ -190,41 +352,167 @@ class Client:
                 elif type(message) is KeepAlive:
                     pass
                 elif type(message) is Cancel:
-                    pass    
-                # Requesting this current peer
-                if isChoke == False:
-                    if isInterested == True:
-                        if received_piece == False:
-                            if len(self.pieceTracker.have_pieces) == self.pieceTracker.total_pieces:
-                                print('here before write')
-                                self.pieceTracker._write()
-                                print('Torrent sucessfully done downloading!')
-                                break
-                            else:
-                                # only send request if not done
-                                print('sending a request to peer {}:{}'.format(self.ip, self.port))
-                                received_piece = True
-                                #self.my_state.append('received_piece')             
-                                if await self._request_piece(writer) == 0:
-                                    break
-        except ConnectionError:
-            print('Failed to connect to Peer {}:{}'.format(self.ip, self.port))
-        except (ConnectionRefusedError, TimeoutError):
-            print('Unable to connect to peer due to time out')
-        except (ConnectionResetError, CancelledError):
-            print('Connection closed')
+                    self._cancel_upload(message)
+                # something changed, see if we can request more from this peer
+                self.wakeup()
+        except ConnectionError as e:
+            logger.debug('Failed to connect to Peer %s: %s', self.str_id, e)
+        except (ConnectionRefusedError, TimeoutError, asyncio.TimeoutError):
+            logger.debug('Unable to connect to Peer %s due to time out', self.str_id)
+        except ConnectionResetError:
+            logger.debug('Connection to Peer %s closed', self.str_id)
+        except CancelledError:
+            logger.debug('Connection to Peer %s closed', self.str_id)
+            # cleaned up in finally, whoever cancelled the session has to see it
+            raise
         except Exception as e:
-            print('An error occurred')
-            #self.cancel(writer)
-            print(e)
+            logger.error('An error occurred with Peer %s: %s', self.str_id, e)
             raise e
-        self.cancel(writer)
-    
+        finally:
+            for task in (requester, uploader):
+                if task:
+                    task.cancel()
+            self.pieceTracker.remove_connection(self)
+            if self.stats:
+                self.pieceTracker.metrics.peer_closed(self.remote_id)
+            self._release_outstanding()
+            self.upload_queue.clear()
+            self.pieceTracker.remove_peer(self.remote_id)
+            self.cancel(self.writer)
+
+    def _task_done(self, task):
+        """
+        The request or upload task of the session ended. If it failed (the
+        connection was reset under a drain, a block couldn't be read) the
+        connection is closed, which ends the session too.
+        """
+        if task.cancelled() or task.exception() is None:
+            return
+        logger.debug('Closing Peer %s after an error: %s', self.str_id, task.exception())
+        self.cancel(self.writer)
+
+    def _send(self, message: bytes):
+        """
+        Queue a message on the connection, unless it is already gone
+        """
+        if self.writer and not self.writer.is_closing():
+            self.writer.write(message)
+
+    def send_cancel(self, block: Block):
+        """
+        Withdraw our request for `block`, another peer delivered it first
+        """
+        if self.outstanding.pop((block.piece, block.offset), None) is not None:
+            self._send(Cancel(block.piece, block.offset, block.length).encode())
+            self.wakeup()
+
+    def send_have(self, index: int):
+        """
+        Tell the peer we now have piece `index`
+        """
+        self._send(Have(index).encode())
+
+    def not_interested(self):
+        """
+        Tell the peer we don't want anything more from it
+        """
+        if self.isInterested:
+            self.isInterested = False
+            self._send(NotInterested().encode())
+
+    def choke(self):
+        """
+        Stop serving the peer, its queued requests are dropped
+        """
+        if not self.am_choking:
+            self.am_choking = True
+            self.upload_queue.clear()
+            self._send(Choke().encode())
+
+    def unchoke(self):
+        """
+        Allow the peer to request blocks from us
+        """
+        if self.am_choking:
+            self.am_choking = False
+            self._send(Unchoke().encode())
+
+    def _queue_upload(self, request: Request):
+        """
+        Queue a block request of the peer, requests we can't or won't
+        serve are ignored
+        """
+        if self.am_choking or not self.block_reader:
+            return
+        tracker = self.pieceTracker
+        if not 0 <= request.index < tracker.total_pieces or not tracker.have[request.index]:
+            return
+        if request.length > MAX_REQUEST_SIZE or \
+           request.begin + request.length > tracker.storage.piece_size(request.index):
+            return
+        if len(self.upload_queue) >= MAX_UPLOAD_QUEUE:
+            logger.debug('Peer %s has too many requests queued, ignoring', self.str_id)
+            return
+        self.upload_queue.append(request)
+        self._can_upload.set()
+
+    def _cancel_upload(self, cancel: Cancel):
+        """
+        Drop a queued request the peer no longer wants
+        """
+        for request in self.upload_queue:
+            if (request.index, request.begin, request.length) == \
+               (cancel.index, cancel.begin, cancel.length):
+                self.upload_queue.remove(request)
+                break
+
+    async def _upload_loop(self):
+        """
+        Serves the peer's requests in the order they came in, each block is
+        read through the read cache and paced by the rate limiter
+        """
+        while True:
+            await self._can_upload.wait()
+            self._can_upload.clear()
+            while self.upload_queue and not self.am_choking:
+                request = self.upload_queue.popleft()
+                block = await self.block_reader.read(request.index, request.begin, request.length)
+                if self.rate_limiter:
+                    await self.rate_limiter.consume(len(block))
+                if self.am_choking:
+                    # choked the peer while we were waiting
+                    break
+                self.writer.write(Piece(request.index, request.begin, block).encode())
+                await self.writer.drain()
+                self.uploaded += len(block)
+                self.stats.bytes_out += len(block)
+                self.pieceTracker.uploaded += len(block)
+
+    def wakeup(self):
+        """
+        Let the request loop know it may be able to send more requests
+        """
+        self._can_request.set()
+
+    async def _request_loop(self, writer):
+        """
+        Keeps the request pipeline to this peer topped up. When there is
+        nothing to ask this peer for we stay connected, a failed hash check
+        or a disconnecting peer may put blocks back up for grabs.
+        """
+        while True:
+            await self._can_request.wait()
+            self._can_request.clear()
+            # Requesting this current peer
+            if not self.isChoke and self.isInterested:
+                if len(self.outstanding) < self.window:
+                    await self._request_piece(writer)
+
     def cancel(self, writer):
         """
         Sends the cancel message to the remote peer and closes the connection.
         """
-        print('Closing peer {id}'.format(id=self.str_id))
+        logger.debug('Closing peer %s', self.str_id)
         if writer:
             writer.close()
         
@@ -233,82 +521,129 @@ class Client:
 async iterator continuously reads from
 the given stream reader and tries to parse valid BitTorrent messages from
 off that stream of bytes.
+
+Data is read in large chunks and every complete message inside a chunk is
+framed in place: the messages hold memoryviews into the chunk, so a Piece
+payload reaches the piece tracker without being copied. Only a message
+that straddles two reads is assembled in `self.buffer`.
+
+A message longer than `max_length`, or a fixed size message of the wrong
+size, raises ConnectionError: the peer is broken or hostile.
 """
 class PeerStream:
-    def __init__(self, reader, buf: bytes=None):
+    def __init__(self, reader, buf: bytes=None, chunk_size: int=CHUNK_SIZE,
+                 max_length: int=MAX_MESSAGE_LENGTH):
         self.reader = reader
-        self.buffer = buf
-
-
-    async def __aiter__(self):
+        self.chunk_size = chunk_size
+        self.max_length = max_length
+        # the partial message left over from the previous read
+        self.buffer = bytearray(buf or b'')
+        # messages framed but not handed out yet
+        self.messages = deque()
+
+    def __aiter__(self):
         return self
 
     async def __anext__(self):
-        header_length = 4
-        while True:
-            msg_len = await self.reader.read(4)
-
-            while(len(msg_len) < 4):
-                left = await self.reader.read(4 - len(msg_len))
-                msg_len += left
-
-            #converting to integer
-            converted = struct.unpack('>I', msg_len[0:4])[0]
+        while not self.messages:
+            data = await self.reader.read(self.chunk_size)
+            if not data:
+                # the remote peer closed the connection
+                raise StopAsyncIteration()
+            self._feed(data)
+        return self.messages.popleft()
 
-            if converted == 0:
-                return KeepAlive()
-            
-            res = await self.reader.read(converted)
-            #keep readin until we get the full packet
-            while len(res) < converted:
-                extra = await self.reader.read(converted - len(res))
-                res += extra
+    def _feed(self, data: bytes):
+        """
+        Frame as many messages as possible out of the newly read data
+        """
+        view = memoryview(data)
+        pos = 0
+        end = len(view)
+
+        if self.buffer:
+            # finish the message that was cut off by the previous read
+            pos = self._complete_partial(view)
+            if pos is None:
+                return
+
+        while end - pos >= 4:
+            length = unpack_from('>I', view, pos)[0]
+            self._check_length(length)
+            if end - pos - 4 < length:
+                break
+            self._decode(view[pos + 4:pos + 4 + length])
+            pos += 4 + length
+
+        if pos < end:
+            self.buffer += view[pos:]
+
+    def _complete_partial(self, view):
+        """
+        Append just enough of `view` to the buffered partial message to
+        complete it. Returns the position in `view` after the consumed bytes
+        or None if all of `view` went into the buffer.
+        """
+        missing = 4 - len(self.buffer)
+        if missing > 0:
+            self.buffer += view[:missing]
+            if len(self.buffer) < 4:
+                return None
+            pos = missing
+        else:
+            pos = 0
 
-            if res is None:
-                raise StopAsyncIteration()
-            
-            # Payload format: <id><payload>
-            self.buffer = self.buffer + res
-            message_id = struct.unpack('>b', self.buffer[0:1])[0]
-
-            def consume(buf):
-                """Consume the current message from the read buffer"""
-                return self.buffer[converted:]
-            
-            if message_id == CHOKE:
-                self.buffer = consume(self.buffer)
-                return Choke()
-            elif message_id == UNCHOKE:
-                self.buffer = consume(self.buffer)
-                return Unchoke()
-            elif message_id == INTERESTED:
-                self.buffer = consume(self.buffer)
-                return Interested()
-            elif message_id == NOTINTERESTED:
-                self.buffer = cconsume(self.buffer)
-                return NotInterested()
-            elif message_id == HAVE:
-                result = Have.decode(self.buffer)
-                self.buffer = consume(self.buffer)
-                return result
-            elif message_id == BITFIELD:
-                result = Bitfield.decode(self.buffer)
-                self.buffer = consume(self.buffer)
-                return result
-            elif message_id == REQUEST:
-                result = Request.decode(self.buffer)
-                self.buffer = consume(self.buffer)
-                return result
-            elif message_id == PIECE:
-                result = Piece.decode(self.buffer)
-                self.buffer = consume(self.buffer)
-                return result
-            elif message_id == CANCEL:
-                self.buffer = consume(self.buffer)
-                return Cancel()
-            else:
-                print("Unsupported message with message_id: {}".format(message_id))
-                exit(1)
+        length = unpack_from('>I', self.buffer, 0)[0]
+        self._check_length(length)
+        missing = 4 + length - len(self.buffer)
+        if missing > len(view) - pos:
+            self.buffer += view[pos:]
+            return None
 
+        # every byte of the message is copied into the buffer once, the
+        # message is decoded in place and keeps the buffer it points into
+        self.buffer += view[pos:pos + missing]
+        message, self.buffer = self.buffer, bytearray()
+        self._decode(memoryview(message)[4:])
+        return pos + missing
 
+    def _check_length(self, length: int):
+        # refuse before buffering up to 4 GiB for a single message
+        if length > self.max_length:
+            raise ConnectionError('message of {} bytes is too long'.format(length))
 
+    def _decode(self, data):
+        """
+        Turn one framed message (without its length prefix) into a message
+        object and queue it
+        """
+        if len(data) == 0:
+            self.messages.append(KeepAlive())
+            return
+
+        message_id = data[0]
+        expected = MESSAGE_LENGTHS.get(message_id)
+        if (expected is not None and len(data) != expected) or \
+           (message_id == PIECE and len(data) < 9):
+            raise ConnectionError('message {} of {} bytes is malformed'.format(message_id, len(data)))
+        if message_id == CHOKE:
+            self.messages.append(Choke())
+        elif message_id == UNCHOKE:
+            self.messages.append(Unchoke())
+        elif message_id == INTERESTED:
+            self.messages.append(Interested())
+        elif message_id == NOTINTERESTED:
+            self.messages.append(NotInterested())
+        elif message_id == HAVE:
+            self.messages.append(Have.decode(data))
+        elif message_id == BITFIELD:
+            self.messages.append(Bitfield.decode(data))
+        elif message_id == REQUEST:
+            self.messages.append(Request.decode(data))
+        elif message_id == PIECE:
+            self.messages.append(Piece.decode(data))
+        elif message_id == CANCEL:
+            self.messages.append(Cancel.decode(data))
+        else:
+            # e.g. PORT or extension messages, which we don't speak
+            logger.debug('Unsupported message with message_id: %d', message_id)
@@ -0,0 +1,50 @@
+import logging
+import logging.handlers
+import queue
+import sys
+
+# format of every log line
+FORMAT = '%(asctime)s %(levelname)-7s %(name)s: %(message)s'
+DEFAULT_LEVEL = 'INFO'
+
+
+def parse_levels(spec: str) -> dict:
+    """
+    Parses per subsystem levels given as "client=DEBUG,tracker=WARNING",
+    the subsystems being the logger (module) names
+    """
+    levels = {}
+    for item in filter(None, (part.strip() for part in (spec or '').split(','))):
+        name, sep, level = item.partition('=')
+        if not sep:
+            raise ValueError('expected subsystem=LEVEL, got {!r}'.format(item))
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup(level: str = DEFAULT_LEVEL, levels: dict = None, stream=None):
+    """
+    Routes the records of every logger through a queue to a handler that
+    writes them to `stream` (stderr by default) on a background thread, so a
+    slow terminal or pipe never blocks the event loop.
+    Args:
+        level (str): level of every subsystem without one of its own
+        levels (dict): subsystem (logger name) -> level
+    Returns:
+        the QueueListener, stop() it before exiting to flush the queue
+    """
+    records = queue.SimpleQueue()
+    handler = logging.StreamHandler(stream or sys.stderr)
+    handler.setFormatter(logging.Formatter(FORMAT))
+    listener = logging.handlers.QueueListener(records, handler, respect_handler_level=False)
+
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.setLevel(level.upper())
+    for name, subsystem_level in (levels or {}).items():
+        logging.getLogger(name).setLevel(subsystem_level)
+
+    listener.start()
+    return listener
@@ -0,0 +1,259 @@
+import asyncio
+import json
+import time
+from bisect import bisect_left
+
+# upper bounds (in seconds) of the block latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# seconds between two snapshots written to the metrics file
+SNAPSHOT_INTERVAL = 10
+
+
+class Histogram:
+    """
+    Counts observations into fixed buckets, Prometheus style
+    """
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        # one count per bucket plus the +Inf one
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+        (upper bound, number of observations <= bound) of every bucket
+        """
+        total = 0
+        result = []
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class PeerStats:
+    """
+    The metrics of one peer session. The client updates the fields directly,
+    so the block path only pays for a few attribute updates.
+    """
+    __slots__ = ('peer', 'bytes_in', 'bytes_out', 'latency', 'in_flight',
+                 'choked_seconds', '_choked_since', 'closed')
+
+    def __init__(self, peer: str):
+        self.peer = peer
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # request -> block arrival time
+        self.latency = Histogram()
+        self.in_flight = 0
+        # time the peer kept us choked, sessions start out choked
+        self.choked_seconds = 0.0
+        self._choked_since = time.monotonic()
+        self.closed = False
+
+    def choked(self):
+        if self._choked_since is None:
+            self._choked_since = time.monotonic()
+
+    def unchoked(self):
+        if self._choked_since is not None:
+            self.choked_seconds += time.monotonic() - self._choked_since
+            self._choked_since = None
+
+    def choked_total(self) -> float:
+        """
+        Time choked so far, including the current choke
+        """
+        if self._choked_since is None:
+            return self.choked_seconds
+        return self.choked_seconds + time.monotonic() - self._choked_since
+
+
+class Metrics:
+    """
+    Registry of the download's metrics: the per peer stats plus the torrent
+    wide counters. Gauges are read from callbacks at snapshot time.
+    The snapshot file and the Prometheus endpoint read them independently:
+    each gets the piece rate since its own previous read, and peers that
+    disconnected are dropped once every reader has seen them closed.
+    """
+    def __init__(self):
+        # session id -> PeerStats
+        self.peers = {}
+        self.hash_failures = 0
+        self.pieces_completed = 0
+        # name -> callable returning the current value
+        self.gauges = {}
+        self.started = time.monotonic()
+        # reader -> (time, pieces completed) of its previous read
+        self._last_read = {}
+        # session of a closed peer -> readers that have seen it closed
+        self._closed_seen = {}
+
+    def peer(self, session, name: str) -> PeerStats:
+        """
+        Stats of a new peer session
+        """
+        stats = PeerStats(name)
+        self.peers[session] = stats
+        return stats
+
+    def peer_closed(self, session):
+        stats = self.peers.get(session)
+        if stats:
+            stats.unchoked()
+            stats.closed = True
+            if not self._last_read:
+                # nobody reads the metrics, no reason to keep the peer around
+                del self.peers[session]
+
+    def add_reader(self, reader: str):
+        """
+        Registers an exporter of the metrics, closed peers are kept until
+        every registered reader collected them
+        """
+        self._last_read.setdefault(reader, (time.monotonic(), self.pieces_completed))
+
+    def gauge(self, name: str, read):
+        """
+        Report `read()` as the gauge `name`
+        """
+        self.gauges[name] = read
+
+    def _collect(self, reader: str):
+        """
+        The current peers and the piece completion rate since `reader` last
+        collected them. A disconnected peer is forgotten once every reader
+        has collected it.
+        """
+        now = time.monotonic()
+        last_time, last_completed = self._last_read.get(reader, (self.started, 0))
+        rate = (self.pieces_completed - last_completed) / max(now - last_time, 1e-6)
+        self._last_read[reader] = (now, self.pieces_completed)
+
+        peers = list(self.peers.items())
+        for session, stats in peers:
+            if stats.closed:
+                seen = self._closed_seen.setdefault(session, set())
+                seen.add(reader)
+                if self._last_read.keys() <= seen:
+                    del self.peers[session]
+                    del self._closed_seen[session]
+        return [stats for _, stats in peers], rate
+
+    def snapshot(self) -> dict:
+        """
+        All metrics as one JSON serializable dict
+        """
+        peers, rate = self._collect('snapshot')
+        return {
+            'time': time.time(),
+            'uptime': time.monotonic() - self.started,
+            'pieces_completed': self.pieces_completed,
+            'piece_rate': rate,
+            'hash_failures': self.hash_failures,
+            'gauges': {name: read() for name, read in self.gauges.items()},
+            'peers': [{
+                'peer': stats.peer,
+                'bytes_in': stats.bytes_in,
+                'bytes_out': stats.bytes_out,
+                'in_flight': stats.in_flight,
+                'choked_seconds': round(stats.choked_total(), 3),
+                'latency': {
+                    'count': stats.latency.count,
+                    'sum': stats.latency.sum,
+                    'buckets': [[bound if bound != float('inf') else '+Inf', count]
+                                for bound, count in stats.latency.cumulative()],
+                },
+                'closed': stats.closed,
+            } for stats in peers],
+        }
+
+    def prometheus(self) -> str:
+        """
+        All metrics in the Prometheus text exposition format
+        """
+        peers, rate = self._collect('prometheus')
+        lines = [
+            '# TYPE bt_pieces_completed_total counter',
+            'bt_pieces_completed_total {}'.format(self.pieces_completed),
+            '# TYPE bt_piece_rate gauge',
+            'bt_piece_rate {}'.format(rate),
+            '# TYPE bt_hash_failures_total counter',
+            'bt_hash_failures_total {}'.format(self.hash_failures),
+        ]
+        for name, read in self.gauges.items():
+            lines.append('# TYPE bt_{} gauge'.format(name))
+            lines.append('bt_{} {}'.format(name, read()))
+
+        def per_peer(name, kind, value):
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for stats in peers:
+                lines.append('{}{{peer="{}"}} {}'.format(name, stats.peer, value(stats)))
+
+        per_peer('bt_peer_bytes_in_total', 'counter', lambda stats: stats.bytes_in)
+        per_peer('bt_peer_bytes_out_total', 'counter', lambda stats: stats.bytes_out)
+        per_peer('bt_peer_requests_in_flight', 'gauge', lambda stats: stats.in_flight)
+        per_peer('bt_peer_choked_seconds_total', 'counter', lambda stats: stats.choked_total())
+
+        lines.append('# TYPE bt_block_latency_seconds histogram')
+        for stats in peers:
+            for bound, count in stats.latency.cumulative():
+                le = '+Inf' if bound == float('inf') else bound
+                lines.append('bt_block_latency_seconds_bucket{{peer="{}",le="{}"}} {}'
+                             .format(stats.peer, le, count))
+            lines.append('bt_block_latency_seconds_sum{{peer="{}"}} {}'.format(stats.peer, stats.latency.sum))
+            lines.append('bt_block_latency_seconds_count{{peer="{}"}} {}'.format(stats.peer, stats.latency.count))
+        return '\n'.join(lines) + '\n'
+
+
+async def write_snapshots(metrics: Metrics, path: str, interval: float = SNAPSHOT_INTERVAL):
+    """
+    Appends a JSON line snapshot of the metrics to `path` every interval,
+    and a last one when cancelled
+    """
+    metrics.add_reader('snapshot')
+    try:
+        while True:
+            await asyncio.sleep(interval)
+            _append_snapshot(metrics, path)
+    finally:
+        _append_snapshot(metrics, path)
+
+
+def _append_snapshot(metrics: Metrics, path: str):
+    with open(path, 'a') as f:
+        f.write(json.dumps(metrics.snapshot()) + '\n')
+
+
+async def serve_prometheus(metrics: Metrics, port: int, host: str = '127.0.0.1'):
+    """
+    Serves the metrics in the Prometheus text format over HTTP, whatever
+    the path asked for
+    Returns:
+        the asyncio server, close it to stop serving
+    """
+    metrics.add_reader('prometheus')
+
+    async def handle(reader, writer):
+        try:
+            await reader.readuntil(b'\r\n\r\n')
+            body = metrics.prometheus().encode()
+            writer.write(b'HTTP/1.0 200 OK\r\n'
+                         b'Content-Type: text/plain; version=0.0.4\r\n'
+                         b'Content-Length: %d\r\n\r\n' % len(body) + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
@@ -0,0 +1,153 @@
+import asyncio
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# most peer connections we keep open at once, incoming ones included
+MAX_CONNECTIONS = 50
+# seconds to wait before reconnecting to a peer, doubled for every failed
+# attempt in a row
+BACKOFF = 30
+# failed attempts in a row after which a peer is banned
+MAX_FAILURES = 5
+
+
+class PeerManager:
+    """
+    Keeps at most `max_connections` peer sessions running. Peers from the
+    trackers wait in a queue of candidates and a free slot is refilled from
+    it as soon as a session ends. A peer we could not connect to (or that
+    failed the handshake) is retried after an exponential backoff and
+    banned once it failed MAX_FAILURES times in a row.
+    """
+    def __init__(self, new_client, max_connections: int = MAX_CONNECTIONS,
+                 backoff: float = BACKOFF, max_failures: int = MAX_FAILURES):
+        self.new_client = new_client
+        self.max_connections = max_connections
+        self.backoff = backoff
+        self.max_failures = max_failures
+        # candidates waiting for a free slot, and the same as a set
+        self.queue = deque()
+        self.queued = set()
+        # (ip, port) -> task running the session with that peer
+        self.active = {}
+        # ip of the peers that connected to us, their port is an ephemeral
+        # source port and says nothing about the peer
+        self.inbound = set()
+        # (ip, port) -> number of failed attempts in a row
+        self.failures = {}
+        # (ip, port) -> timer putting the peer back in the queue
+        self.retries = {}
+        self.banned = set()
+        # ip of the banned peers, for the incoming connections
+        self.banned_ips = set()
+        self.closed = False
+
+    def _busy(self) -> int:
+        return len(self.active) + len(self.inbound)
+
+    def _known(self, peer) -> bool:
+        return peer in self.active or peer in self.inbound or peer in self.queued \
+            or peer in self.retries or peer in self.banned or peer[0] in self.inbound
+
+    def add_peers(self, peers):
+        """
+        Queue the peers of a tracker response we don't know about yet
+        """
+        for peer in peers:
+            peer = tuple(peer)
+            if not self._known(peer):
+                self.queue.append(peer)
+                self.queued.add(peer)
+        self._fill()
+
+    def _fill(self):
+        """
+        Start sessions with queued peers while there are free slots
+        """
+        while self.queue and self._busy() < self.max_connections:
+            peer = self.queue.popleft()
+            self.queued.discard(peer)
+            if peer[0] in self.inbound:
+                # it connected to us while it was waiting
+                continue
+            task = asyncio.ensure_future(self._session(peer))
+            self.active[peer] = task
+
+    async def _session(self, peer):
+        client = self.new_client(*peer)
+        try:
+            await client.start()
+        finally:
+            del self.active[peer]
+            if self.closed:
+                return
+            if client.connected:
+                # the session ran, the peer may come back later
+                self.failures.pop(peer, None)
+                self._retry_later(peer, self.backoff)
+            else:
+                failures = self.failures.get(peer, 0) + 1
+                self.failures[peer] = failures
+                if failures >= self.max_failures:
+                    logger.info('Banning peer %s:%s', *peer)
+                    self._ban(peer)
+                else:
+                    self._retry_later(peer, self.backoff * 2 ** (failures - 1))
+            self._fill()
+
+    def _retry_later(self, peer, delay: float):
+        loop = asyncio.get_event_loop()
+        self.retries[peer] = loop.call_later(delay, self._retry, peer)
+
+    def _retry(self, peer):
+        del self.retries[peer]
+        if not self._known(peer):
+            self.queue.append(peer)
+            self.queued.add(peer)
+            self._fill()
+
+    def ban(self, peer):
+        """
+        Never connect to (or accept) this peer again
+        """
+        self._ban(tuple(peer))
+
+    def _ban(self, peer):
+        self.banned.add(peer)
+        self.banned_ips.add(peer[0])
+
+    def accept(self, ip, port) -> bool:
+        """
+        Whether an incoming connection of this peer may be served. Called
+        from the task serving it, the slot is freed when that task ends.
+        Incoming peers are known by their ip only: one we are already
+        connected to, either way, or one we banned is refused.
+        """
+        if ip in self.banned_ips or ip in self.inbound or \
+           any(peer[0] == ip for peer in self.active) or \
+           self._busy() >= self.max_connections:
+            return False
+        self.inbound.add(ip)
+        asyncio.current_task().add_done_callback(lambda task: self._inbound_done(ip))
+        return True
+
+    def _inbound_done(self, ip):
+        self.inbound.discard(ip)
+        self._fill()
+
+    async def close(self):
+        """
+        End every session and forget the queued peers
+        """
+        self.closed = True
+        for timer in self.retries.values():
+            timer.cancel()
+        self.retries.clear()
+        self.queue.clear()
+        self.queued.clear()
+        tasks = list(self.active.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
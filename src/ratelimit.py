@@ -0,0 +1,33 @@
+import asyncio
+import time
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every connection it throttles. Tokens are bytes
+    and are refilled at `rate` per second, up to `burst` of them can be
+    spent at once. A rate of 0 (or None) means unlimited.
+    """
+    def __init__(self, rate: float = None, burst: int = None):
+        self.rate = rate or 0
+        self.burst = burst or max(int(self.rate), 2**16)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    async def consume(self, amount: int):
+        """
+        Waits until `amount` bytes may be sent. The tokens are taken right
+        away and may go negative, later callers then wait for the debt to
+        be paid off, so large sends can't be starved by small ones.
+        """
+        if not self.rate:
+            return
+        self._refill()
+        self.tokens -= amount
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
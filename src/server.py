@@ -0,0 +1,80 @@
+import asyncio
+import logging
+import struct
+
+from torrent import Torrent
+
+logger = logging.getLogger(__name__)
+
+# seconds a connecting peer has to send its handshake
+HANDSHAKE_TIMEOUT = 10
+
+
+class PeerServer:
+    """
+    Accepts the connections other peers open to us. The handshake is read
+    and checked here, then the connection is handed to a Client created by
+    `new_client(ip, port)` which runs the rest of the session. The connection
+    is refused when `new_client` returns None.
+    """
+    def __init__(self, torrent: Torrent, new_client, host: str = '0.0.0.0', port: int = 6881):
+        self.torrent = torrent
+        self.new_client = new_client
+        self.host = host
+        self.port = port
+        self.server = None
+        # sessions of the accepted peers
+        self.tasks = set()
+
+    async def start(self):
+        """
+        Start listening on the port. When it is taken (e.g. by another
+        client) we go on without accepting connections, downloading only
+        needs the connections we open.
+        """
+        try:
+            self.server = await asyncio.start_server(self._accept, self.host, self.port)
+        except OSError as e:
+            logger.warning('Not accepting peer connections, cannot listen on port %d: %s',
+                           self.port, e)
+            return
+        logger.info('Listening for peers on port %d', self.port)
+
+    async def _accept(self, reader, writer):
+        ip, port = writer.get_extra_info('peername')[:2]
+        try:
+            data = await asyncio.wait_for(reader.readexactly(68), HANDSHAKE_TIMEOUT)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            writer.close()
+            return
+
+        pstrlen, pstr, info_hash, _ = struct.unpack('>B19s8x20s20s', data)
+        if pstrlen != 19 or pstr != b'BitTorrent protocol' or \
+           info_hash != self.torrent.info_hash:
+            logger.debug('Rejecting handshake from Peer %s:%s', ip, port)
+            writer.close()
+            return
+
+        client = self.new_client(ip, port)
+        if client is None:
+            # no room for (or no interest in) this peer
+            writer.close()
+            return
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        try:
+            await client.serve(reader, writer)
+        finally:
+            self.tasks.discard(task)
+
+    async def close(self):
+        """
+        Stop listening and end the sessions of the accepted peers
+        """
+        if self.server:
+            self.server.close()
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        if self.server:
+            await self.server.wait_closed()
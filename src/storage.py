@@ -0,0 +1,208 @@
+import asyncio
+import os
+from array import array
+from bisect import bisect_right
+from collections import namedtuple, OrderedDict
+from typing import List
+
+from torrent import Torrent
+
+# A contiguous run of bytes of a request that lives in a single file.
+# `start` and `end` are relative to the beginning of the request.
+Segment = namedtuple('Segment', ['fd', 'file_offset', 'start', 'end'])
+
+# bytes of piece data kept in memory for uploading
+READ_CACHE_SIZE = 2**26
+
+class Storage:
+    """
+    Maps the torrent's pieces onto the output file(s).
+
+    The torrent is one continuous byte stream that is cut into files. The
+    file boundaries and, for every piece, the first file it overlaps are
+    computed once, so any (piece, offset, length) is translated into file
+    segments without walking the file list and pieces can be written in any
+    order.
+    """
+    def __init__(self, torrent: Torrent, output_dir: str = 'result'):
+        self.torrent = torrent
+        self.piece_length = torrent.piece_length
+        self.total_size = torrent.total_size
+
+        self.fd = []
+        # fd -> size of the file when it was opened, i.e. data of an earlier run
+        self.existing_sizes = {}
+        # where each file starts and ends within the torrent's byte stream
+        self.file_starts = []
+        self.file_ends = []
+        # every path is checked before the first file is created
+        paths = [self._file_path(output_dir, file.name) for file in torrent.files]
+        offset = 0
+        for file, path in zip(torrent.files, paths):
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.fd.append(os.open(path, os.O_RDWR | os.O_CREAT))
+            self.file_starts.append(offset)
+            self.existing_sizes[self.fd[-1]] = os.fstat(self.fd[-1]).st_size
+            offset += file.length
+            self.file_ends.append(offset)
+
+        # index of the first file holding data of each piece
+        total_pieces = len(torrent.pieces)
+        self.piece_first_file = array('I', bytes(4 * total_pieces))
+        file_idx = 0
+        for index in range(total_pieces):
+            start = index * self.piece_length
+            while self.file_ends[file_idx] <= start:
+                file_idx += 1
+            self.piece_first_file[index] = file_idx
+
+    @staticmethod
+    def _file_path(output_dir: str, name) -> str:
+        """
+        Path of an output file, `name` is either the file name of a
+        single-file torrent or the list of path components of a multi-file one.
+        The names come from the torrent: a component that would put the file
+        outside of output_dir (absolute, '..', holding a separator) is refused
+        with a ValueError.
+        """
+        parts = name if type(name) is list else [name]
+        parts = [part.decode('utf-8') if type(part) is bytes else part for part in parts]
+        for part in parts:
+            if part in ('', '.', '..') or os.path.isabs(part) or os.sep in part or \
+               (os.altsep and os.altsep in part) or '\0' in part:
+                raise ValueError('Unsafe path in torrent: {!r}'.format(part))
+        return os.path.join(output_dir, *parts)
+
+    def segments(self, piece: int, offset: int, length: int) -> List[Segment]:
+        """
+        Splits `length` bytes at `offset` within `piece` into per-file segments
+        """
+        start = piece * self.piece_length + offset
+        end = min(start + length, self.total_size)
+        file_idx = self.piece_first_file[piece]
+        if offset:
+            # the request may begin past the files the piece starts in
+            file_idx = bisect_right(self.file_ends, start, file_idx)
+
+        result = []
+        while start < end:
+            file_end = self.file_ends[file_idx]
+            if file_end > start:
+                hi = min(end, file_end)
+                result.append(Segment(self.fd[file_idx],
+                                      start - self.file_starts[file_idx],
+                                      start - piece * self.piece_length - offset,
+                                      hi - piece * self.piece_length - offset))
+                start = hi
+            file_idx += 1
+        return result
+
+    def piece_size(self, piece: int) -> int:
+        """
+        Size of the piece, only the last one can be shorter
+        """
+        return min(self.piece_length, self.total_size - piece * self.piece_length)
+
+    def on_disk(self, piece: int) -> bool:
+        """
+        Whether the files already held data covering all of `piece` when
+        they were opened
+        """
+        return all(self.existing_sizes[segment.fd] >=
+                   segment.file_offset + segment.end - segment.start
+                   for segment in self.segments(piece, 0, self.piece_size(piece)))
+
+    def file_stats(self) -> List:
+        """
+        (size, modification time in ns) of every file, in torrent order
+        """
+        stats = []
+        for fd in self.fd:
+            stat = os.fstat(fd)
+            stats.append([stat.st_size, stat.st_mtime_ns])
+        return stats
+
+    def write(self, piece: int, offset: int, buffers: List):
+        """
+        Writes the given buffers, back to back, at `offset` within `piece`.
+        Each file segment is written with a single pwritev call.
+        """
+        buffers = [memoryview(buf) for buf in buffers]
+        length = sum(len(buf) for buf in buffers)
+        for segment in self.segments(piece, offset, length):
+            chunks = _slice_buffers(buffers, segment.start, segment.end)
+            if hasattr(os, 'pwritev'):
+                os.pwritev(segment.fd, chunks, segment.file_offset)
+            else:
+                os.pwrite(segment.fd, b''.join(chunks), segment.file_offset)
+
+    def read(self, piece: int, offset: int, length: int) -> bytes:
+        """
+        Reads `length` bytes at `offset` within `piece` back from the file(s)
+        """
+        return b''.join(os.pread(segment.fd, segment.end - segment.start, segment.file_offset)
+                        for segment in self.segments(piece, offset, length))
+
+    def close(self):
+        """
+        Close the open output files
+        """
+        for fd in self.fd:
+            os.close(fd)
+        self.fd = []
+
+
+class ReadCache:
+    """
+    Serves the blocks peers request from us. Peers usually ask for a whole
+    piece block after block, so the piece is read from disk once (in the
+    executor, to keep the event loop free) and kept around in LRU order.
+    """
+    def __init__(self, storage: Storage, size: int = READ_CACHE_SIZE, executor=None):
+        self.storage = storage
+        self.executor = executor
+        self.capacity = max(1, size // storage.piece_length)
+        # piece index -> future of the piece's data
+        self.pieces = OrderedDict()
+
+    async def read(self, piece: int, offset: int, length: int) -> memoryview:
+        """
+        Returns `length` bytes at `offset` within `piece`
+        """
+        data = self.pieces.get(piece)
+        if data is None:
+            # the future is cached right away so concurrent requests for the
+            # same piece share a single disk read
+            loop = asyncio.get_event_loop()
+            data = loop.run_in_executor(self.executor, self.storage.read,
+                                        piece, 0, self.storage.piece_size(piece))
+            self.pieces[piece] = data
+            if len(self.pieces) > self.capacity:
+                self.pieces.popitem(last=False)
+        else:
+            self.pieces.move_to_end(piece)
+        try:
+            block = await asyncio.shield(data)
+        except Exception:
+            self.pieces.pop(piece, None)
+            raise
+        return memoryview(block)[offset:offset + length]
+
+
+def _slice_buffers(buffers: List[memoryview], start: int, end: int) -> List[memoryview]:
+    """
+    Returns the views covering bytes [start, end) of the concatenation of
+    `buffers`, without copying them
+    """
+    result = []
+    pos = 0
+    for buf in buffers:
+        buf_end = pos + len(buf)
+        if buf_end > start and pos < end:
+            result.append(buf[max(start - pos, 0):min(end, buf_end) - pos])
+        pos = buf_end
+        if pos >= end:
+            break
+    return result
@@ -1,55 +1,103 @@
 from typing import List, NamedTuple
-from bencoding import Decoder, Encoder
+from bencoding import Decoder
 from collections import namedtuple
+from functools import cached_property
 from hashlib import sha1
 
 # represents a file within the metainfo's info dict
 TorrentFile = namedtuple('TorrentFile', ['name', 'length'])
 
+# strings at least this long (the piece hashes) are kept as views into the
+# torrent file's bytes instead of being copied out
+ZERO_COPY_THRESHOLD = 2**12
+
+
+class PieceHashes:
+    """
+    The 20-byte SHA1 hashes of the pieces, indexed in O(1) out of the one
+    contiguous `pieces` string of the info dict
+    """
+    def __init__(self, data):
+        self._data = memoryview(data)
+        self._count = len(self._data) // 20
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, index: int) -> bytes:
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError('piece index {} out of range'.format(index))
+        return self._data[index * 20:index * 20 + 20].tobytes()
+
+    def __iter__(self):
+        for index in range(self._count):
+            yield self[index]
+
 class Torrent:
     """
     This class is a wrapper around the information found inside a 
     .torrent file.
+    The file is only read here, it is parsed the first time any of its
+    information is needed and everything derived from it is computed once.
     """
     def __init__(self, filename) -> None:
         
         self.filename = filename # torrent filename
-        self.files = []
 
-        # parse metadata inside torrent file
         with open(self.filename, 'rb') as f:
-            metainfo = f.read()
-            self.metainfo = Decoder(metainfo).decode()
-            self.info_hash = self._hash_info()
-            self._extract_file()
+            self._raw = f.read()
+
+    @cached_property
+    def _decoded(self):
+        # parse metadata inside torrent file
+        decoder = Decoder(self._raw, zero_copy_threshold=ZERO_COPY_THRESHOLD)
+        return decoder.decode(), decoder.spans
+
+    @cached_property
+    def metainfo(self) -> dict:
+        """
+        The decoded contents of the torrent file
+        """
+        return self._decoded[0]
+
+    @cached_property
+    def info_hash(self) -> bytes:
+        return self._hash_info(self._raw, self._decoded[1][b'info'])
 
-    def _hash_info(self) -> bytes:
+    def _hash_info(self, metainfo: bytes, span) -> bytes:
         """
         Creates a urlencoded 20-byte SHA1 hash of the value of the info 
         key from the torrent file. The info value will be a bencoded 
-        dictionary.
+        dictionary, it is hashed exactly as it appears in the file instead
+        of being encoded again.
+        Args:
+            metainfo (bytes): the contents of the torrent file
+            span (tuple): start and end offset of the info value in `metainfo`
         Returns:
             20-byte info hash
         """
-        info = Encoder(self.metainfo[b'info']).encode()
-        info_hash = sha1(info).digest()
+        start, end = span
+        info_hash = sha1(memoryview(metainfo)[start:end]).digest()
         return info_hash
 
-    def _extract_file(self):
+    @cached_property
+    def files(self) -> List[TorrentFile]:
         """
         This function identifies and extracts the file(s) of the torrent from the 
         info field of the metainfo.
         """
         if self.multi_file:
             # multi-file torrent
-            self.files = [ TorrentFile(file[b'path'], file[b'length']) for file in self.metainfo[b'info'][b'files']]
+            return [ TorrentFile(file[b'path'], file[b'length']) for file in self.metainfo[b'info'][b'files']]
         else:
             # single-file torrent
             name = self.metainfo[b'info'][b'name'].decode('utf-8') # filename
             length = self.metainfo[b'info'][b'length'] # length of file in bytes
-            self.files.append(TorrentFile(name, length))
+            return [TorrentFile(name, length)]
 
-    @property
+    @cached_property
     def multi_file(self) -> bool:
         """
         Checks if torrent is mutli-file
@@ -59,7 +107,7 @@ class Torrent:
         """
         return b'files' in self.metainfo[b'info']
 
-    @property
+    @cached_property
     def total_size(self) -> int:
         """
         This function gets the total size of the torrent's file(s)
@@ -91,8 +139,25 @@ class Torrent:
             str: the announce URL of the tracker
         """
         return self.metainfo[b'announce'].decode('utf-8')
-    
+
     @property
+    def announce_list(self) -> List[List[str]]:
+        """
+        This function decodes the tiers of tracker URLs of the announce-list
+        extension (BEP 12), falling back to the single announce URL
+        Returns:
+            List: one list of announce URLs per tier
+        """
+        tiers = []
+        for tier in self.metainfo.get(b'announce-list', []):
+            urls = [url.decode('utf-8') for url in tier if url]
+            if urls:
+                tiers.append(urls)
+        if not tiers and b'announce' in self.metainfo:
+            tiers.append([self.announce])
+        return tiers
+    
+    @cached_property
     def piece_length(self) -> int:
         """
         This function decodes the number of bytes in each piece
@@ -101,19 +166,11 @@ class Torrent:
         """
         return self.metainfo[b'info'][b'piece length']
 
-    @property
-    def pieces(self) -> List:
+    @cached_property
+    def pieces(self) -> PieceHashes:
         """
         This function decodes the str of all 20-byte SHA1 hash values
         Returns:
-            List: SHA1 hash of each piece
+            PieceHashes: SHA1 hash of each piece, by index
         """
-        data = self.metainfo[b'info'][b'pieces']
-        pieces = []
-        offset = 0
-        length = len(data)
-
-        while offset < length:
-            pieces.append(data[offset:offset+20])
-            offset += 20
-        return pieces
\ No newline at end of file
+        return PieceHashes(self.metainfo[b'info'][b'pieces'])
\ No newline at end of file
@@ -1,16 +1,39 @@
-import http
+import asyncio
+import logging
 import random
 import socket
-from http import client
+import time
 from bencoding import Decoder
 from torrent import Torrent
-from urllib import request, parse
+from udptracker import UDPTracker
+from urllib import parse
 from collections import namedtuple
-from struct import unpack
+from struct import error as StructError, unpack
+
+logger = logging.getLogger(__name__)
 
 # represents a peer from the tracker's response
 Peer = namedtuple('Peer', ['ip', 'port'])
 
+# the port we announce to the tracker when none is given
+PORT = 6881
+# seconds to wait for a tracker to answer an announce
+TRACKER_TIMEOUT = 30
+# seconds to wait for the tracker to acknowledge that we leave
+STOP_TIMEOUT = 10
+# seconds between announces when the tracker doesn't give an interval
+DEFAULT_INTERVAL = 30 * 60
+# seconds to wait before retrying a failed announce
+RETRY_INTERVAL = 60
+# seconds before a peer handed out by one tracker is passed on again when
+# another (or the same) tracker returns it
+PEER_REFRESH = 5 * 60
+# what an announce raises when the tracker is unreachable or answers with
+# something we can't use: a body that doesn't decode (RuntimeError/EOFError),
+# a dictionary missing keys or holding the wrong types, a short UDP reply
+ANNOUNCE_ERRORS = (ConnectionError, OSError, asyncio.TimeoutError, EOFError, RuntimeError,
+                   KeyError, TypeError, ValueError, AttributeError, StructError)
+
 class TrackerResponse:
     """
     The response from the tracker after a successful connection
@@ -61,7 +84,6 @@ class TrackerResponse:
         """
         #Peer = namedtuple('Peer', ['ip', 'port'])
         peers = self.response[b'peers']
-        print(peers)
         if type(peers) == list:
             ip = None
             port = None
@@ -81,8 +103,7 @@ class TrackerResponse:
                         result.append(Peer(ip, port))
             return result
         else:
-            print('peers is a binary model')
-            print(peers)
+            logger.debug('peers is a binary model of %d bytes', len(peers))
             # split string into pieces of length 6 bytes, where the
             # first 4 bytes is the IP addr and the last 2 is the port no.
             peers = [peers[i:i+6] for i in range(0, len(peers), 6)]
@@ -108,50 +129,146 @@ class Tracker:
     under download or seeding state.
     """
 
-    def __init__(self, torrent: Torrent):
+    def __init__(self, torrent: Torrent, url: str = None, peer_id: str = None,
+                 port: int = PORT):
         self.torrent = torrent
-        self.peer_id = _calculate_peer_id()
+        self.peer_id = peer_id or _calculate_peer_id()
+        # the port we accept peer connections on
+        self.port = port
+        # the announce URL, its scheme decides between HTTP(S) and UDP
+        self.url = url or torrent.announce
+        self.udp = None
+        if parse.urlsplit(self.url).scheme == 'udp':
+            self.udp = UDPTracker(torrent, self.peer_id, self.url)
+        # whether the tracker was told about the `completed` event yet
+        self.completed_sent = False
+        # whether the tracker ever answered us
+        self.announced = False
 
-    def connect(self, first: bool, uploaded: int = 0, downloaded: int = 0):
+    async def connect(self, event: str = None, uploaded: int = 0, downloaded: int = 0,
+                      left: int = None):
         """
         Makes the announce call to the tracker to update metrics on the 
         torrent and get a list of avaliable peers to connect to.
 
         Args:
-            first (bool): Whether or not this is the first announce call
+            event (str, optional): 'started', 'completed' or 'stopped', None for
+                the regular announces
             uploaded (int, optional): The total number of bytes uploaded. Defaults to 0.
             downloaded (int, optional): The total number of bytes downloaded. Defaults to 0.
+            left (int, optional): The number of bytes still to download.
+                Defaults to the torrent size minus `downloaded`.
         """
-        self.http_conn = client.HTTPConnection(self.torrent.announce, 6881)
+        if left is None:
+            left = self.torrent.total_size - downloaded
+
+        if self.udp:
+            response = await self.udp.announce(event=event, uploaded=uploaded,
+                                               downloaded=downloaded, left=left, port=self.port)
+            return TrackerResponse(response)
 
         # create Tracker request
         params = {
             'info_hash': self.torrent.info_hash,
             'peer_id': self.peer_id.encode(),
-            'port': 6881,
+            'port': self.port,
             'uploaded': uploaded,
             'downloaded': downloaded,
-            'left': self.torrent.total_size - downloaded,
+            'left': left,
             'compact': 1
         }
 
-        if first:
-            params['event'] = 'started'
+        if event:
+            params['event'] = event
 
         # add params to tracker url
-        url = self.torrent.announce + '?' + parse.urlencode(params)
+        announce = self.url
+        separator = '&' if '?' in announce else '?'
+        url = announce + separator + parse.urlencode(params)
         # send GET request
-        with request.urlopen(url) as f:
-            if not f.status == 200:
-                raise ConnectionError(f'unable to connect to tracker: status code {f.status}')
-            data = f.read() # read response
-            return TrackerResponse(Decoder(data).decode())
+        status, data = await asyncio.wait_for(_http_get(url), TRACKER_TIMEOUT)
+        if not status == 200:
+            raise ConnectionError(f'unable to connect to tracker: status code {status}')
+        self.raise_for_error(data)
+        return TrackerResponse(Decoder(data).decode())
+
+    async def _announce(self, pieceTracker, event: str = None):
+        return await self.connect(event=event,
+                                  uploaded=pieceTracker.uploaded,
+                                  downloaded=pieceTracker.downloaded,
+                                  left=pieceTracker.left)
+
+    async def run(self, pieceTracker, on_peers):
+        """
+        Announces to the tracker for as long as the download runs: once with
+        `started`, then every interval the tracker asks for with our current
+        counters, and with `completed` as soon as the last piece is verified.
+        The peers of every response are passed to on_peers.
+        Cancel the task running this to stop announcing, then call stop().
+        """
+        event = 'started'
+        # a download that was already complete when we started is never
+        # reported as completed
+        if pieceTracker.complete:
+            self.completed_sent = True
+        while True:
+            if event is None and pieceTracker.complete and not self.completed_sent:
+                event = 'completed'
+            try:
+                response = await self._announce(pieceTracker, event)
+                peers = None if response.failure else response.peers
+            except ANNOUNCE_ERRORS as e:
+                logger.warning('Announce to %s failed: %s', self.url, e)
+                wait = RETRY_INTERVAL
+            else:
+                if response.failure:
+                    logger.warning('Tracker refused the announce: %s', response.failure)
+                    wait = RETRY_INTERVAL
+                else:
+                    if event == 'completed':
+                        self.completed_sent = True
+                    self.announced = True
+                    event = None
+                    wait = response.interval or DEFAULT_INTERVAL
+                    on_peers(peers)
+
+            sleep = asyncio.ensure_future(asyncio.sleep(wait))
+            waiters = [sleep]
+            if event is None and not self.completed_sent:
+                # announce `completed` right away instead of at the next interval
+                waiters.append(asyncio.ensure_future(pieceTracker.completed.wait()))
+            try:
+                await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                for waiter in waiters:
+                    waiter.cancel()
+
+    async def stop(self, pieceTracker):
+        """
+        Tells the tracker we are leaving the swarm (and that we completed the
+        download, if that announce didn't go out yet)
+        """
+        if not self.announced:
+            # it never knew about us
+            return
+        events = ['stopped']
+        if pieceTracker.complete and not self.completed_sent:
+            events.insert(0, 'completed')
+        for event in events:
+            try:
+                await asyncio.wait_for(self._announce(pieceTracker, event), STOP_TIMEOUT)
+            except ANNOUNCE_ERRORS as e:
+                logger.warning('Announce to %s failed: %s', self.url, e)
+                return
+            if event == 'completed':
+                self.completed_sent = True
 
     def close(self):
         """
-        Closes the connection to the tracker server
+        Closes the connection to the tracker server, if we keep one (UDP)
         """
-        self.http_conn.close()
+        if self.udp:
+            self.udp.close()
 
     def raise_for_error(self, tracker_response):
         """
@@ -160,7 +277,7 @@ class Tracker:
         try:
             # a tracker response containing an error will have a utf-8 message only.
             # see: https://wiki.theory.org/index.php/BitTorrentSpecification#Tracker_Response
-            message = tracker_response.decode("utf-8")
+            message = bytes(tracker_response).decode("utf-8")
             if "failure" in message:
                 raise ConnectionError('Unable to connect to tracker: {}'.format(message))
 
@@ -176,6 +293,87 @@ class Tracker:
     #     pass
 
 
+class MultiTracker:
+    """
+    All the trackers of a torrent's announce-list (BEP 12). Every tracker of
+    every tier is announced to concurrently, so a slow or dead tracker never
+    holds up the download: the first tracker to answer with peers starts it.
+    The peers from all trackers are merged and deduplicated before they
+    reach the swarm.
+    """
+    def __init__(self, torrent: Torrent, port: int = PORT):
+        self.torrent = torrent
+        self.peer_id = _calculate_peer_id()
+        self.tiers = []
+        seen = set()
+        for tier in torrent.announce_list:
+            trackers = []
+            for url in tier:
+                scheme = parse.urlsplit(url).scheme
+                if url in seen or scheme not in ('http', 'https', 'udp'):
+                    continue
+                seen.add(url)
+                trackers.append(Tracker(torrent, url, self.peer_id, port))
+            if trackers:
+                self.tiers.append(trackers)
+        # peer -> last time it was passed on to the swarm
+        self.peers_seen = {}
+
+    @property
+    def trackers(self):
+        return [tracker for tier in self.tiers for tracker in tier]
+
+    def _merge(self, on_peers):
+        """
+        Wraps on_peers so it only gets the peers no tracker returned recently
+        """
+        def merged(peers):
+            now = time.monotonic()
+            fresh = []
+            for peer in peers:
+                last = self.peers_seen.get(peer)
+                if last is None or now - last >= PEER_REFRESH:
+                    self.peers_seen[peer] = now
+                    fresh.append(peer)
+            if fresh:
+                on_peers(fresh)
+        return merged
+
+    async def run(self, pieceTracker, on_peers):
+        """
+        Runs the announce loop of every tracker concurrently, see Tracker.run
+        """
+        merged = self._merge(on_peers)
+        tasks = [asyncio.ensure_future(tracker.run(pieceTracker, merged))
+                 for tracker in self.trackers]
+        if not tasks:
+            logger.error('The torrent has no tracker we can announce to')
+            return
+        for tracker, task in zip(self.trackers, tasks):
+            task.add_done_callback(lambda task, url=tracker.url: self._failed(url, task))
+        try:
+            # a tracker whose loop dies must not take the other trackers down
+            await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    @staticmethod
+    def _failed(url, task):
+        if not task.cancelled() and task.exception():
+            logger.error('Stopped announcing to %s: %r', url, task.exception())
+
+    async def stop(self, pieceTracker):
+        """
+        Tells every tracker we are leaving the swarm, concurrently
+        """
+        await asyncio.gather(*[tracker.stop(pieceTracker) for tracker in self.trackers])
+
+    def close(self):
+        for tracker in self.trackers:
+            tracker.close()
+
+
 def _calculate_peer_id():
     """
     Calculate and return a unique Peer ID.
@@ -184,6 +382,56 @@ def _calculate_peer_id():
     """
     return '-RV0001-' + ''.join(str(random.randint(0, 9)) for _ in range(12))
 
+async def _http_get(url: str):
+    """
+    A minimal asynchronous HTTP GET, so announcing never blocks the event loop
+    Returns:
+        (status code, body)
+    """
+    parts = parse.urlsplit(url)
+    secure = parts.scheme == 'https'
+    port = parts.port or (443 if secure else 80)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+
+    reader, writer = await asyncio.open_connection(parts.hostname, port, ssl=secure or None)
+    try:
+        # HTTP/1.0 so the tracker answers with a plain body and closes the connection
+        writer.write('GET {} HTTP/1.0\r\nHost: {}\r\nUser-Agent: RV0001\r\n'
+                     'Connection: close\r\n\r\n'.format(path, parts.netloc).encode('utf-8'))
+        await writer.drain()
+        response = await reader.read()
+    finally:
+        writer.close()
+
+    head, _, body = response.partition(b'\r\n\r\n')
+    lines = head.split(b'\r\n')
+    status_line = lines[0].split()
+    if len(status_line) < 2 or not status_line[1].isdigit():
+        raise ConnectionError('malformed response from tracker')
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(b':')
+        headers[name.strip().lower()] = value.strip()
+    if headers.get(b'transfer-encoding', b'').lower() == b'chunked':
+        body = _dechunk(body)
+    return int(status_line[1]), body
+
+def _dechunk(body: bytes) -> bytes:
+    """
+    Decodes a chunked transfer-encoded HTTP body
+    """
+    result = bytearray()
+    pos = 0
+    while True:
+        end = body.index(b'\r\n', pos)
+        size = int(body[pos:end].split(b';')[0], 16)
+        if size == 0:
+            return bytes(result)
+        result += body[end + 2:end + 2 + size]
+        pos = end + 2 + size + 2
+
 def decode_port(port):
     """
     Converts a 32-bit packed binary port number to int
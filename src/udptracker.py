@@ -0,0 +1,194 @@
+import asyncio
+import logging
+import random
+import struct
+import time
+from urllib import parse
+
+logger = logging.getLogger(__name__)
+
+# UDP tracker protocol (BEP 15)
+# magic constant identifying the protocol in a connect request
+PROTOCOL_ID = 0x41727101980
+
+# actions
+CONNECT = 0
+ANNOUNCE = 1
+SCRAPE = 2
+ERROR = 3
+
+# announce events
+EVENTS = {None: 0, 'completed': 1, 'started': 2, 'stopped': 3}
+
+# seconds a connection ID may be used for after it was handed out
+CONNECTION_ID_LIFETIME = 60
+# a request is retried after BASE_TIMEOUT * 2**n seconds, n being the attempt
+BASE_TIMEOUT = 15
+MAX_RETRIES = 8
+
+
+class UDPTrackerProtocol(asyncio.DatagramProtocol):
+    """
+    Datagram endpoint talking to one UDP tracker. Responses are matched to
+    the requests waiting for them by their transaction id.
+    """
+    def __init__(self):
+        self.transport = None
+        # transaction id -> future waiting for the response
+        self.waiters = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        if len(data) < 8:
+            return
+        transaction_id = struct.unpack_from('>I', data, 4)[0]
+        waiter = self.waiters.pop(transaction_id, None)
+        if waiter and not waiter.done():
+            waiter.set_result(data)
+
+    def error_received(self, exc):
+        # e.g. ICMP port unreachable, let the requests time out and retry
+        logger.debug('UDP tracker error: %s', exc)
+
+    def connection_lost(self, exc):
+        for waiter in self.waiters.values():
+            if not waiter.done():
+                waiter.set_exception(ConnectionError('UDP tracker endpoint closed'))
+        self.waiters.clear()
+
+
+class UDPTracker:
+    """
+    Announces to (and scrapes) a tracker over UDP. A connection ID is
+    obtained once and reused for as long as the protocol allows, lost
+    datagrams are retransmitted with exponential backoff.
+    """
+    def __init__(self, torrent, peer_id: str, url: str,
+                 base_timeout: float = BASE_TIMEOUT, max_retries: int = MAX_RETRIES):
+        self.torrent = torrent
+        self.peer_id = peer_id
+        parts = parse.urlsplit(url)
+        self.address = (parts.hostname, parts.port or 80)
+        self.base_timeout = base_timeout
+        self.max_retries = max_retries
+        self.protocol = None
+        self.connection_id = None
+        self.connection_time = 0
+
+    async def _endpoint(self) -> UDPTrackerProtocol:
+        if self.protocol is None or self.protocol.transport.is_closing():
+            loop = asyncio.get_event_loop()
+            _, self.protocol = await loop.create_datagram_endpoint(
+                UDPTrackerProtocol, remote_addr=self.address)
+        return self.protocol
+
+    async def _request(self, build, action: int, attempt: int) -> bytes:
+        """
+        Sends one request and waits for its response for at most
+        base_timeout * 2**attempt seconds
+        Args:
+            build: called with the transaction id, returns the datagram (it is
+                called again for every attempt, with the current connection ID)
+            action (int): the action expected in the response
+        """
+        protocol = await self._endpoint()
+        transaction_id = random.getrandbits(32)
+        waiter = asyncio.get_event_loop().create_future()
+        protocol.waiters[transaction_id] = waiter
+        try:
+            protocol.transport.sendto(build(transaction_id))
+            data = await asyncio.wait_for(waiter, self.base_timeout * 2 ** attempt)
+        finally:
+            protocol.waiters.pop(transaction_id, None)
+
+        response_action = struct.unpack_from('>I', data)[0]
+        if response_action == ERROR:
+            raise ConnectionError('Tracker error: {}'.format(
+                data[8:].decode('utf-8', 'replace')))
+        if response_action != action:
+            raise ConnectionError('unexpected action {} from UDP tracker'.format(response_action))
+        return data
+
+    async def _with_retries(self, build, action: int) -> bytes:
+        """
+        Retransmits the request with exponential backoff until it is answered
+        """
+        for attempt in range(self.max_retries + 1):
+            if action != CONNECT:
+                # the connection ID may have expired while we were retrying
+                await self._connect()
+            try:
+                return await self._request(build, action, attempt)
+            except asyncio.TimeoutError:
+                logger.info('UDP tracker %s:%s did not answer, retrying', *self.address)
+        raise asyncio.TimeoutError('UDP tracker {}:{} is not answering'.format(*self.address))
+
+    async def _connect(self):
+        """
+        Obtains a connection ID unless the current one is still valid
+        """
+        if self.connection_id is not None and \
+           time.monotonic() - self.connection_time < CONNECTION_ID_LIFETIME:
+            return
+        data = await self._with_retries(
+            lambda tid: struct.pack('>QII', PROTOCOL_ID, CONNECT, tid), CONNECT)
+        self.connection_id = struct.unpack_from('>Q', data, 8)[0]
+        self.connection_time = time.monotonic()
+
+    async def announce(self, event: str = None, uploaded: int = 0, downloaded: int = 0,
+                       left: int = 0, port: int = 6881) -> dict:
+        """
+        Makes the announce call
+        Returns:
+            the answer in the same shape as a decoded HTTP tracker response
+        """
+        key = random.getrandbits(32)
+
+        def build(tid):
+            return struct.pack(
+                '>QII20s20sQQQIIIiH',
+                self.connection_id, ANNOUNCE, tid,
+                self.torrent.info_hash, self.peer_id.encode(),
+                downloaded, left, uploaded,
+                EVENTS[event],
+                0,      # IP address, 0 means the sender's
+                key,
+                -1,     # number of peers wanted, -1 for the tracker's default
+                port)
+
+        data = await self._with_retries(build, ANNOUNCE)
+        interval, leechers, seeders = struct.unpack_from('>III', data, 8)
+        return {
+            b'interval': interval,
+            b'incomplete': leechers,
+            b'complete': seeders,
+            # same layout as the compact peer list of an HTTP tracker
+            b'peers': data[20:len(data) - (len(data) - 20) % 6],
+        }
+
+    async def scrape(self, info_hashes=None):
+        """
+        Asks the tracker for the swarm statistics of the given info hashes
+        (our torrent's by default)
+        Returns:
+            a list of {'complete', 'downloaded', 'incomplete'} dicts, in order
+        """
+        info_hashes = info_hashes or [self.torrent.info_hash]
+
+        def build(tid):
+            return struct.pack('>QII', self.connection_id, SCRAPE, tid) + b''.join(info_hashes)
+
+        data = await self._with_retries(build, SCRAPE)
+        result = []
+        for offset in range(8, len(data) - 11, 12):
+            complete, downloaded, incomplete = struct.unpack_from('>III', data, offset)
+            result.append({'complete': complete, 'downloaded': downloaded,
+                           'incomplete': incomplete})
+        return result
+
+    def close(self):
+        if self.protocol and self.protocol.transport:
+            self.protocol.transport.close()
+        self.protocol = None